@@ -8,9 +8,15 @@ else:
     import multiprocessing
     from multiprocessing.managers import BaseManager
 from queue import LifoQueue
+from collections import deque
 import time
 import signal
 import copy
+import json
+import pickle
+import random
+import socket
+import threading
 
 
 class LifoManager(BaseManager):
@@ -25,13 +31,376 @@ class LifoManager(BaseManager):
 LifoManager.register('LifoQueue', LifoQueue)
 
 
-class Backtracker():
+class SearchStats():
+    """Counters describing a search, kept by every backtrack() worker.
+
+    nodes: partial solutions expanded.
+    children: partial solutions returned by next_choice_func.
+    pruned: children rejected by partial_checker.
+    solutions: partial solutions accepted by candidate_matcher.
+    max_depth: depth of the deepest node, counting the starting guesses as 0.
+    max_stack: the most partial solutions waiting on the local stack at once.
+    donated, received: work items given to and taken from other workers.
+    choice_time: seconds spent in next_choice_func.
+    check_time: seconds spent in partial_checker and candidate_matcher.
+    queue_wait: seconds spent waiting for donated work that then arrived.
+    idle_time: seconds spent waiting when no work came, or paused.
+    elapsed: seconds from the start of the search to the return of backtrack().
+    workers: the number of workers whose counters were added up. The
+        searches a Backtracker or BacktrackerPool does in the calling process
+        before starting its workers count as none.
+    best, best_score: the highest scoring partial solution seen and its score,
+        if the search was given a partial_score function (see backtrack()).
+        Not included in as_dict().
+
+    Stats of several workers are combined with merge(), which adds up the
+    counters and times and keeps the largest depths and the best partial."""
+
+    COUNTERS = ("nodes", "children", "pruned", "solutions", "donated", "received",
+                "choice_time", "check_time", "queue_wait", "idle_time", "elapsed", "workers")
+    MAXIMA = ("max_depth", "max_stack")
+
+    def __init__(self, **values):
+        for name in self.COUNTERS + self.MAXIMA:
+            setattr(self, name, 0)
+        self.workers = 1
+        self.best = None
+        self.best_score = None
+        for name, v in values.items():
+            if name not in self.COUNTERS + self.MAXIMA:
+                raise ValueError("Unknown statistic: {}".format(name))
+            setattr(self, name, v)
+
+    def merge(self, other) -> None:
+        """Add the counters of other to these."""
+        for name in self.COUNTERS:
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+        for name in self.MAXIMA:
+            setattr(self, name, max(getattr(self, name), getattr(other, name)))
+        if other.best is not None:
+            self.consider(other.best, other.best_score)
+
+    def consider(self, partial, score) -> None:
+        """Keep partial as the best one if score beats the best score so far."""
+        if self.best is None or score > self.best_score:
+            self.best = partial
+            self.best_score = score
+
+    @classmethod
+    def combine(cls, stats):
+        """Return the merged stats of an iterable of SearchStats."""
+        total = cls(workers=0)
+        for s in stats:
+            total.merge(s)
+        return total
+
+    def nodes_per_second(self) -> float:
+        """Return the nodes expanded per second of search time."""
+        busy = self.choice_time + self.check_time
+        return self.nodes / busy if busy else 0.0
+
+    def as_dict(self) -> dict:
+        return {name: getattr(self, name) for name in self.COUNTERS + self.MAXIMA}
+
+    def to_json(self) -> str:
+        return json.dumps(self.as_dict(), sort_keys=True)
+
+    def __repr__(self) -> str:
+        return "SearchStats({})".format(", ".join(
+            "{}={!r}".format(k, v) for k, v in self.as_dict().items()))
+
+
+class WorkExchange():
+    """Shared state that lets backtracking workers hand work to each other.
+
+    Every worker searches depth first on its own local stack. A worker that
+    runs dry announces itself as idle and waits on the shared queue; busy
+    workers notice idle workers through wants_work() and donate the oldest
+    (shallowest, and so usually largest) subproblems from the bottom of their
+    stacks, one for each idle worker. The search is over when every worker is idle and no donated work
+    is in flight, at which point the done event is set.
+
+    The found event is set whenever a worker reports a solution and the stop
+    event asks all workers to return as soon as they can. wakeup is set along
+    with done or found so that a parent process has a single event to wait on.
+    reason() tells why the search stopped, see STOP_REASONS.
+
+    A job may have a deadline (in time.time() seconds) and a budget of nodes,
+    which the workers charge() as they go. Whichever runs out first halts
+    the search. Workers only charge every LIMIT_INTERVAL nodes, so searches
+    overrun their limits a little.
+
+    Solutions go through the exchange's own solutions queue, and every worker
+    puts its SearchStats on the stats queue when it returns. Everything put on
+    the queues is tagged with the current job number, so an exchange can be
+    reset() and reused for another search without stale items leaking in.
+    num_solutions counts the solutions put so far, and once it reaches
+    max_solutions (if nonzero) the stop event is set.
+    """
+
+    def __init__(self, num_workers=1):
+        self.queue = multiprocessing.Queue()
+        self.solutions = multiprocessing.Queue()
+        self.stats = multiprocessing.Queue()
+        self.lock = multiprocessing.Lock()
+        self.done = multiprocessing.Event()
+        self.found = multiprocessing.Event()
+        self.stop = multiprocessing.Event()
+        self.wakeup = multiprocessing.Event()
+        # the counters are only modified while holding self.lock
+        self.num_workers = multiprocessing.Value('i', num_workers, lock=False)
+        self.idle = multiprocessing.Value('i', 0, lock=False)
+        self.in_flight = multiprocessing.Value('i', 0, lock=False)
+        self.num_solutions = multiprocessing.Value('i', 0, lock=False)
+        self.max_solutions = multiprocessing.Value('i', 0, lock=False)
+        self.job = multiprocessing.Value('i', 0, lock=False)
+        self.stop_reason = multiprocessing.Value('i', 0, lock=False)
+        self.nodes = multiprocessing.Value('q', 0, lock=False)
+        self.max_nodes = multiprocessing.Value('q', 0, lock=False)
+        self.deadline = multiprocessing.Value('d', 0.0, lock=False)
+
+    def reset(self, max_solutions=None, deadline=None, max_nodes=None) -> None:
+        """Start a new job. Only call this while no worker is searching."""
+        with self.lock:
+            self.job.value += 1
+            self.idle.value = 0
+            self.in_flight.value = 0
+            self.num_solutions.value = 0
+            self.max_solutions.value = max_solutions or 0
+            self.stop_reason.value = 0
+            self.nodes.value = 0
+            self.max_nodes.value = max_nodes or 0
+            self.deadline.value = deadline or 0.0
+        for e in (self.done, self.found, self.stop, self.wakeup):
+            e.clear()
+        # drop any stats of earlier jobs that nobody asked for
+        while True:
+            try:
+                self.stats.get_nowait()
+            except queue.Empty:
+                break
+
+    def offer(self, item, depth=0) -> None:
+        """Make item, a node at the given depth, available to idle workers."""
+        with self.lock:
+            self.in_flight.value += 1
+        self.queue.put((self.job.value, depth, item))
+
+    def wants_work(self) -> bool:
+        """Return whether there are more idle workers than donated items."""
+        return self.idle.value > self.in_flight.value
+
+    def take(self, poll_interval=0.01):
+        """Wait for a donated item as an idle worker.
+        Returns (depth, item), or None once all of the work is done."""
+        with self.lock:
+            self.idle.value += 1
+        while not self.stopped():
+            try:
+                job, depth, item = self.queue.get(timeout=poll_interval)
+            except queue.Empty:
+                with self.lock:
+                    over = (self.idle.value == self.num_workers.value and
+                            self.in_flight.value == 0)
+                if over:
+                    # nobody is left to offer work, so it can't change now
+                    self.finish()
+                continue
+            if job != self.job.value:
+                # left over from an earlier job
+                continue
+            with self.lock:
+                self.in_flight.value -= 1
+                self.idle.value -= 1
+            return depth, item
+        return None
+
+    def finish(self) -> None:
+        """Signal that the whole search tree has been explored."""
+        self._set_reason("exhausted")
+        self.done.set()
+        self.wakeup.set()
+
+    def halt(self, reason) -> None:
+        """Ask every worker to stop, for one of STOP_REASONS."""
+        self._set_reason(reason)
+        self.stop.set()
+        self.wakeup.set()
+
+    def _set_reason(self, reason) -> None:
+        # the first reason given sticks
+        with self.lock:
+            if self.stop_reason.value == 0:
+                self.stop_reason.value = STOP_REASONS.index(reason)
+
+    def reason(self):
+        """Return why the search stopped (one of STOP_REASONS), or None."""
+        return STOP_REASONS[self.stop_reason.value]
+
+    def charge(self, nodes) -> bool:
+        """Count nodes more nodes against the budget, halting the search if
+        it or the deadline has run out. Returns whether workers should stop."""
+        with self.lock:
+            self.nodes.value += nodes
+            over = self.max_nodes.value and self.nodes.value >= self.max_nodes.value
+        if over:
+            self.halt("node_budget")
+        elif self.deadline.value and time.time() >= self.deadline.value:
+            self.halt("deadline")
+        return self.stopped()
+
+    def put_solution(self, item) -> None:
+        """Put item on the solutions queue and signal that it is there."""
+        with self.lock:
+            self.num_solutions.value += 1
+            enough = self.num_solutions.value == self.max_solutions.value
+        self.solutions.put((self.job.value, item))
+        self.found.set()
+        if enough:
+            self.halt("solutions")
+        self.wakeup.set()
+
+    def get_solution(self, block=True, timeout=None):
+        """Remove and return a solution of the current job."""
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            if deadline is not None:
+                timeout = max(0, deadline - time.time())
+            job, item = self.solutions.get(block, timeout)
+            if job == self.job.value:
+                return item
+
+    def put_stats(self, stats) -> None:
+        """Report the SearchStats of a worker."""
+        self.stats.put((self.job.value, stats))
+
+    def collect_stats(self, count, timeout=1.0) -> list:
+        """Return the SearchStats of up to count workers of the current job,
+        waiting at most timeout seconds for them to arrive."""
+        deadline = time.time() + timeout
+        out = []
+        while len(out) < count:
+            try:
+                job, stats = self.stats.get(timeout=max(0, deadline - time.time()))
+            except queue.Empty:
+                break
+            if job == self.job.value:
+                out.append(stats)
+        return out
+
+    def stopped(self) -> bool:
+        """Return whether workers should stop searching."""
+        return self.stop.is_set() or self.done.is_set()
+
+
+# why a search stopped: still running, every node explored, max_solutions
+# found, deadline passed, node budget spent, or stopped from outside
+STOP_REASONS = (None, "exhausted", "solutions", "deadline", "node_budget", "cancelled")
+
+
+class _Cell():
+    """Stands in for a multiprocessing.Value in a LocalExchange."""
+
+    def __init__(self, value):
+        self.value = value
+
+
+class LocalExchange(WorkExchange):
+    """A WorkExchange for a search that runs in a single process.
+    Creating the pipes, locks and shared memory of a WorkExchange takes
+    milliseconds, this takes microseconds."""
+
+    def __init__(self, num_workers=1):
+        self.queue = queue.Queue()
+        self.solutions = queue.Queue()
+        self.stats = queue.Queue()
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+        self.found = threading.Event()
+        self.stop = threading.Event()
+        self.wakeup = threading.Event()
+        self.num_workers = _Cell(num_workers)
+        self.idle = _Cell(0)
+        self.in_flight = _Cell(0)
+        self.num_solutions = _Cell(0)
+        self.max_solutions = _Cell(0)
+        self.job = _Cell(0)
+        self.stop_reason = _Cell(0)
+        self.nodes = _Cell(0)
+        self.max_nodes = _Cell(0)
+        self.deadline = _Cell(0.0)
+
+
+class _ExchangeStatus():
+    """Methods for following a search through self.exchange."""
+
+    serial_stats = ()
+
+    def get_solution(self, block=True, timeout=None):
+        """Remove and return a decoded solution from solutions_queue."""
+        return self.decode(self.exchange.get_solution(block, timeout))
+
+    def finished(self) -> bool:
+        """Return whether the whole search tree has been explored."""
+        return self.exchange.done.is_set()
+
+    def has_solution(self) -> bool:
+        """Return whether any worker has found a solution yet."""
+        return self.exchange.found.is_set()
+
+    def wait(self, timeout=None) -> bool:
+        """Block until a solution has been found or the search is over.
+        Returns False if timeout seconds passed first."""
+        return self.exchange.wakeup.wait(timeout)
+
+    def stats(self, timeout=1.0):
+        """Return the combined SearchStats of the workers of the last search.
+        Call it once the search has stopped (after terminate() or cancel()):
+        it waits up to timeout seconds for every worker to report, and
+        keeps the stats of the individual workers in worker_stats. The stats
+        of any search done in this process are in serial_stats."""
+        self.worker_stats += self.exchange.collect_stats(
+            self.exchange.num_workers.value - len(self.worker_stats), timeout)
+        return SearchStats.combine(self.worker_stats + list(self.serial_stats))
+
+    def reason(self):
+        """Return why the search stopped (one of STOP_REASONS), or None if
+        it hasn't."""
+        return self.exchange.reason()
+
+    def best_partial(self, timeout=1.0):
+        """Return the decoded highest scoring partial solution reached by
+        the last search (see partial_score), or None. Call it once the
+        search has stopped, as for stats()."""
+        best = self.stats(timeout).best
+        return None if best is None else self.decode(best)
+
+    def iter_solutions(self, poll_interval=0.05):
+        """Generate decoded solutions as they are found, until the search
+        is over (every solution has been received) or stopped."""
+        received = 0
+        while True:
+            try:
+                item = self.exchange.get_solution(timeout=poll_interval)
+            except queue.Empty:
+                ex = self.exchange
+                if ex.max_solutions.value and received >= ex.max_solutions.value:
+                    return
+                if ((ex.done.is_set() or ex.stop.is_set()) and
+                        received >= ex.num_solutions.value):
+                    return
+                continue
+            received += 1
+            yield self.decode(item)
+
+
+class Backtracker(_ExchangeStatus):
     """A class that handles backtracking using multiple processes.
     Reflects the API used by the backtracking function itself.
     Given the functions necessary to perform backtracking this class
         """
 
-    def __init__(self, *, next_choice_func=None,  starting_guesses: list = None, partial_checker=None, candidate_matcher=None):
+    def __init__(self, *, next_choice_func=None,  starting_guesses: list = None, partial_checker=None, candidate_matcher=None, encode=None, decode=None, max_solutions=None, serial_nodes=None, serial_time=None, search_factory=None, max_nodes=None, timeout=None, partial_score=None, split_factor=None, estimate=None, choose_workers=None):
         """next_choice_func: a function which takes a list (a partial solution) and returns a list of possible next choices.
 
         starting_guesses: a list of sequences (partial solutions) from which the algorithm should start building.
@@ -42,6 +411,38 @@ class Backtracker():
         candidate_matcher: a function which returns whether a partial solution has the form of a final solution.
             In the case of solving sudoku, the candidate_matcher might be same as the partial_checker but also 
             checks for the correct length of the solution.
+
+        encode, decode: optional functions converting partial solutions to and from a compact
+            picklable form. Everything passed between processes goes through them,
+            including what is put on solutions_queue (use get_solution() to read it back).
+
+        max_solutions: if given, all workers stop once this many solutions have been found.
+
+        serial_nodes, serial_time: if either is given, go() first searches in this process
+            and only starts the worker processes if the search isn't over after serial_nodes
+            nodes or serial_time seconds, handing them the unexplored partial solutions.
+            Small searches then cost no more than a function call.
+
+        search_factory: optional, explores whole subtrees in place instead of going
+            through next_choice_func for every node, see backtrack().
+
+        max_nodes, timeout: if given, the search stops once the workers (and the
+            serial search) have explored max_nodes nodes between them, or timeout
+            seconds after go(), whichever comes first. reason() then tells which.
+
+        partial_score: optional function scoring partial solutions, the best scoring
+            one reached is kept and returned by best_partial(). Useful to report how
+            far a search that ran out of time got.
+
+        split_factor, estimate: before starting the workers, go() splits the
+            subproblems left into at least split_factor (SPLIT_FACTOR by default) per
+            worker, so that none of them starts idle, see split_frontier().
+
+        choose_workers: optional function deciding how many workers go() starts, in
+            place of its numthreads. It is called with the list of partials left
+            once the serial search (if any) is over and the SearchStats of that
+            search, and returns 0 to finish the search in this process instead.
+            See estimate_tree_size().
         """
 
         if None in [next_choice_func, partial_checker]:
@@ -51,25 +452,65 @@ class Backtracker():
         self.starting_guesses = copy.deepcopy(starting_guesses)
         self.partial_checker = copy.deepcopy(partial_checker)
         self.candidate_matcher = copy.deepcopy(candidate_matcher)
-        # instantiate a manager that knows lifo queues
-        self.manager = LifoManager()
-        self.manager.start()
-        self.intermediate_queue = self.manager.LifoQueue()
-        self.solutions_queue = self.manager.LifoQueue()
-        self.discard_queue = self.manager.LifoQueue()
-        # self.intermediate_queue = multiprocessing.Queue()
-
-        # feed in the starting guesses
+        self.encode = encode if encode is not None else _identity
+        self.decode = decode if decode is not None else _identity
+        self.serial_nodes = serial_nodes
+        self.serial_time = serial_time
+        self.search_factory = search_factory
+        self.max_nodes = max_nodes
+        self.timeout = timeout
+        self.partial_score = partial_score
+        self.split_factor = SPLIT_FACTOR if split_factor is None else split_factor
+        self.estimate = estimate
+        self.choose_workers = choose_workers
+        self.adaptive = serial_nodes is not None or serial_time is not None
+        if self.adaptive:
+            # only pay for a WorkExchange if the workers are needed
+            self.exchange = LocalExchange(num_workers=0)
+        else:
+            # go() counts the workers in as it starts them, so that a search
+            # over before then doesn't leave stats() waiting for any
+            self.exchange = WorkExchange(num_workers=0)
+        self.exchange.max_solutions.value = max_solutions or 0
+        self.exchange.max_nodes.value = max_nodes or 0
+        self.intermediate_queue = self.exchange.queue
+        self.solutions_queue = self.exchange.solutions
+
+        # the starting guesses, the top of the stack first
+        self._frontier = deque()
         for s in starting_guesses:
             for g in next_choice_func(s):
-                self.intermediate_queue.put(g)
+                self._frontier.appendleft((1, g))
 
+        self.worker_stats = []
+        self.serial_stats = []
         self.outboxes = []
         self.children = []
 
     def go(self, numthreads=1):
+        if self.timeout is not None:
+            self.exchange.deadline.value = time.time() + self.timeout
+        if self.adaptive and self._search_serially():
+            return
+        if self.choose_workers is not None:
+            stats = self.serial_stats[0] if self.serial_stats else SearchStats()
+            numthreads = self.choose_workers([p for _, p in reversed(self._frontier)], stats)
+            if numthreads == 0:
+                # no limits but the job's, so this ends the search
+                self.serial_nodes = self.serial_time = None
+                self._search_serially()
+                return
+        if self.adaptive:
+            self._spill()
+        if self._split(numthreads):
+            return
+        # the top of the stack goes first, as it would have serially
+        while self._frontier:
+            depth, partial = self._frontier.pop()
+            self.exchange.offer(self.encode(partial), depth)
+        self.exchange.num_workers.value = numthreads
         for _ in range(numthreads):
-            newbox = queue.Queue()
+            newbox = multiprocessing.Queue()
             self.outboxes.append(newbox)
             self.children.append(
                 multiprocessing.Process(
@@ -77,10 +518,14 @@ class Backtracker():
                         "next_choice_func": copy.deepcopy(self.next_choice_func),
                         "partial_checker": self.partial_checker,
                         "candidate_matcher": self.candidate_matcher,
-                        "intermediate_queue": self.intermediate_queue,
                         "solutions_queue": self.solutions_queue,
                         "mailbox": newbox,
-                        "discard": None
+                        "discard": None,
+                        "exchange": self.exchange,
+                        "encode": self.encode,
+                        "decode": self.decode,
+                        "search_factory": self.search_factory,
+                        "partial_score": self.partial_score,
                     }
                 )
             )
@@ -88,12 +533,89 @@ class Backtracker():
             t.start()
             # time.sleep(0.1)
 
-    def terminate(self):
-        """Terminate all child processes."""
-        self.msg_all(1)
+    def _search_serially(self) -> bool:
+        """Search in this process within the serial limits.
+        Returns whether the search is over."""
+        stats = SearchStats(workers=0)
+        self.serial_stats.append(stats)
+        ex = self.exchange
+
+        def found(partial):
+            ex.put_solution(self.encode(partial))
+            return ex.stop.is_set()
+        # what is left of the budget, should an earlier pass have used some
+        budget = self.max_nodes and max(1, self.max_nodes - ex.nodes.value)
+        max_nodes = _least(self.serial_nodes, budget)
+        if ex.deadline.value:
+            max_time = _least(self.serial_time, max(0, ex.deadline.value - time.time()))
+        else:
+            max_time = self.serial_time
+        if self.search_factory is not None:
+            _serial_subtrees(self._frontier, self.search_factory, stats, found,
+                             max_nodes=max_nodes, max_time=max_time,
+                             partial_score=self.partial_score)
+        else:
+            _serial_search(self._frontier, self.next_choice_func, self.partial_checker,
+                           self.candidate_matcher, stats, found,
+                           max_nodes=max_nodes, max_time=max_time,
+                           partial_score=self.partial_score)
+        if stats.best is not None:
+            stats.best = self.encode(stats.best)
+        if ex.stop.is_set():
+            return True
+        if not self._frontier:
+            ex.finish()
+            return True
+        # the workers only get what is left of the budget and the time
+        return ex.charge(stats.nodes)
+
+    def _split(self, numthreads) -> bool:
+        """Split the frontier for numthreads workers, see split_frontier().
+        Returns whether that was the end of the search."""
+        if not self.split_factor:
+            return False
+        stats = SearchStats(workers=0)
+        self.serial_stats.append(stats)
+        ex = self.exchange
+
+        def found(partial):
+            ex.put_solution(self.encode(partial))
+            return ex.stop.is_set()
+        items = split_frontier(reversed(self._frontier), self.split_factor * numthreads,
+                               self.next_choice_func, self.partial_checker,
+                               self.candidate_matcher, found, stats, self.estimate)
+        self._frontier = deque(reversed(items))
+        if ex.stop.is_set():
+            return True
+        if not items:
+            ex.finish()
+            return True
+        return ex.charge(stats.nodes)
+
+    def _spill(self):
+        """Move the search to a WorkExchange for the worker processes."""
+        local = self.exchange
+        self.exchange = WorkExchange(num_workers=0)
+        for name in ("max_solutions", "max_nodes", "nodes", "deadline"):
+            getattr(self.exchange, name).value = getattr(local, name).value
+        while not local.solutions.empty():
+            self.exchange.put_solution(local.get_solution())
+        self.intermediate_queue = self.exchange.queue
+        self.solutions_queue = self.exchange.solutions
+        self.adaptive = False
+
+    def terminate(self, grace=1.0):
+        """Stop all child processes.
+        Workers are asked to stop and given grace seconds to return on their
+        own before being killed."""
+        self.exchange.halt("cancelled")
+        deadline = time.time() + grace
         for t in self.children:
-            t.terminate()
-            t.join()
+            t.join(max(0, deadline - time.time()))
+        for t in self.children:
+            if t.is_alive():
+                t.terminate()
+                t.join()
 
     def msg_all(self, m):
         """Put a message in mailbox queues of all children."""
@@ -106,67 +628,975 @@ class Backtracker():
             t.join()
 
 
+# how many subproblems per worker a search is split into before it starts
+SPLIT_FACTOR = 4
+# how many nodes a worker expands between checks of its mailbox
+MAILBOX_INTERVAL = 64
+# and between checks of the node budget and deadline of a job that has them,
+# as nodes of big boards can take milliseconds
+LIMIT_INTERVAL = 8
+
+
+def _identity(x):
+    return x
+
+
+def _least(a, b):
+    """Return the smaller of two optional limits."""
+    if a is None:
+        return b
+    return a if b is None else min(a, b)
+
+
+class BacktrackerPool(_ExchangeStatus):
+    """Long-lived backtracking worker processes that run one search after another.
+
+    Starting processes costs more than many searches do, so the workers stay
+    alive between jobs, parked on their control queues. submit() starts a
+    search, which is followed with wait(), has_solution() and get_solution()
+    as with a Backtracker, and cancel() stops it so the next one can start.
+    The workers share one WorkExchange that is reset() for every job.
+
+    Use it as a context manager, or call close() when done, to shut the
+    workers down.
+    """
+
+    def __init__(self, numthreads=1, *, encode=None, decode=None):
+        """numthreads: number of worker processes.
+
+        encode, decode: see Backtracker. They apply to every job."""
+        self.numthreads = numthreads
+        self.encode = encode if encode is not None else _identity
+        self.decode = decode if decode is not None else _identity
+        self.children = []
+        self.worker_stats = []
+        self._active = False
+        self._start_workers()
+
+    def _start_workers(self):
+        self.exchange = WorkExchange(self.numthreads)
+        self.acks = multiprocessing.Queue()
+        self.controls = [multiprocessing.Queue() for _ in range(self.numthreads)]
+        self.children = [
+            multiprocessing.Process(
+                target=pool_worker,
+                args=(self.exchange, control, self.acks, self.encode, self.decode),
+                daemon=True)
+            for control in self.controls]
+        for t in self.children:
+            t.start()
+
+    def submit(self, *, next_choice_func=None, starting_guesses: list = None, partial_checker=None, candidate_matcher=None, max_solutions=None, search_factory=None, max_nodes=None, timeout=None, partial_score=None, split_factor=None, estimate=None):
+        """Start a new search, cancelling the current one if there is one.
+        The arguments are the same as those of Backtracker, timeout counting
+        from now."""
+        if None in [next_choice_func, partial_checker]:
+            raise ValueError(
+                "Backtracking requires both next_choice_func and partial_checker!")
+        self.cancel()
+        deadline = None if timeout is None else time.time() + timeout
+        self.exchange.reset(max_solutions, deadline, max_nodes)
+        self.worker_stats = []
+        self.serial_stats = []
+        items = [(1, g) for s in starting_guesses for g in next_choice_func(s)]
+        if split_factor is None:
+            split_factor = SPLIT_FACTOR
+        if split_factor:
+            stats = SearchStats(workers=0)
+            self.serial_stats.append(stats)
+
+            def found(partial):
+                self.exchange.put_solution(self.encode(partial))
+                return self.exchange.stop.is_set()
+            items = split_frontier(items, split_factor * self.numthreads, next_choice_func,
+                                   partial_checker, candidate_matcher, found, stats, estimate)
+            self.exchange.charge(stats.nodes)
+        for depth, partial in items:
+            self.exchange.offer(self.encode(partial), depth)
+        job = {
+            "next_choice_func": next_choice_func,
+            "partial_checker": partial_checker,
+            "candidate_matcher": candidate_matcher,
+            "search_factory": search_factory,
+            "partial_score": partial_score,
+        }
+        for control in self.controls:
+            control.put(job)
+        self._active = True
+
+    def cancel(self, grace=1.0):
+        """Stop the current search and wait for the workers to park.
+        Workers that don't stop within grace seconds are killed and the
+        whole pool is restarted, since they may be holding shared locks."""
+        if not self._active:
+            return
+        self.exchange.halt("cancelled")
+        job = self.exchange.job.value
+        deadline = time.time() + grace
+        parked = 0
+        while parked < self.numthreads:
+            try:
+                if self.acks.get(timeout=max(0, deadline - time.time())) == job:
+                    parked += 1
+            except queue.Empty:
+                self._stop_workers()
+                self._start_workers()
+                break
+        self._active = False
+
+    def _stop_workers(self):
+        for t in self.children:
+            t.terminate()
+        for t in self.children:
+            t.join()
+        self.children = []
+
+    def close(self):
+        """Cancel the current search and shut the workers down."""
+        if not self.children:
+            return
+        self.cancel()
+        for control in self.controls:
+            control.put(None)
+        for t in self.children:
+            t.join(1.0)
+        self._stop_workers()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+
+def pool_worker(exchange, control, acks, encode=_identity, decode=_identity):
+    """Worker process of a BacktrackerPool.
+    Runs backtrack() for every job read from control until it reads None,
+    acknowledging each job on acks once it has stopped searching (and has
+    reported its stats)."""
+    while True:
+        job = control.get()
+        if job is None:
+            return
+        backtrack(job["next_choice_func"],
+                  partial_checker=job["partial_checker"],
+                  candidate_matcher=job["candidate_matcher"],
+                  exchange=exchange, encode=encode, decode=decode,
+                  flush_on_stop=True, search_factory=job["search_factory"],
+                  partial_score=job["partial_score"])
+        acks.put(exchange.job.value)
+
+
+class CoordinatorManager(BaseManager):
+    """Manager serving the Coordinator of a DistributedBacktracker over TCP.
+    Each DistributedBacktracker registers its own coordinator on a subclass."""
+
+
+class WorkerManager(BaseManager):
+    """Manager through which remote_worker() reaches a Coordinator."""
+
+
+WorkerManager.register('coordinator')
+
+
+class Coordinator():
+    """The shared state of a distributed search: the queue of unexplored
+    partials, which batches of them are out with which worker, and when each
+    worker was last heard from. Remote workers call its methods through a
+    proxy (see remote_worker()), the rest of the search state lives in a
+    LocalExchange of the coordinating process.
+
+    Work is handed out in leases of up to batch_size partials. A worker
+    that goes heartbeat_timeout seconds without calling in is presumed dead
+    and its leases go back on the queue. Their partials may have been
+    partly explored, so the same solution can be found twice: solutions
+    are only passed on the first time. Partials are encoded throughout."""
+
+    def __init__(self, exchange, job, batch_size=16, heartbeat_timeout=10.0):
+        self.exchange = exchange
+        self.job = job
+        self.batch_size = batch_size
+        self.heartbeat_timeout = heartbeat_timeout
+        self.lock = threading.Lock()
+        # (depth, partial) pairs, taken from the right
+        self.queue = deque()
+        # lease id: (worker id, items)
+        self.leases = {}
+        # worker id: time last heard from
+        self.workers = {}
+        # workers that found the queue empty
+        self.hungry = set()
+        self.seen = set()
+        self.next_id = 0
+        self.requeued = 0
+
+    def _beat(self, worker_id) -> bool:
+        """Note that a worker called in. Returns whether it is still counted
+        as alive (it isn't once it has been given up for dead)."""
+        if worker_id not in self.workers:
+            return False
+        self.workers[worker_id] = time.time()
+        return True
+
+    def _check_done(self) -> None:
+        if not self.queue and not self.leases and not self.exchange.done.is_set():
+            self.exchange.finish()
+
+    def join(self) -> tuple:
+        """Register a new worker. Returns (worker id, job): the job is a dict
+        of the functions of the search, see DistributedBacktracker."""
+        with self.lock:
+            worker_id = self.next_id
+            self.next_id += 1
+            self.workers[worker_id] = time.time()
+            self.exchange.num_workers.value += 1
+        return worker_id, self.job
+
+    def take(self, worker_id):
+        """Lease a batch of partials to a worker.
+        Returns (lease id, [(depth, partial), ...]), [] if there is nothing
+        to hand out right now, or None once the worker should leave."""
+        with self.lock:
+            if self.exchange.stopped() or not self._beat(worker_id):
+                return None
+            if not self.queue:
+                self.hungry.add(worker_id)
+                self._check_done()
+                return None if self.exchange.stopped() else []
+            self.hungry.discard(worker_id)
+            # leave some for the others
+            share = -(-len(self.queue) // max(1, len(self.workers)))
+            items = [self.queue.pop() for _ in range(min(self.batch_size, share))]
+            lease = self.next_id
+            self.next_id += 1
+            self.leases[lease] = (worker_id, items)
+            return lease, items
+
+    def give(self, worker_id, items) -> None:
+        """Put partials split off by a worker back on the queue."""
+        with self.lock:
+            self._beat(worker_id)
+            self.queue.extend(items)
+
+    def done(self, worker_id, lease) -> None:
+        """Release a lease whose partials a worker has fully explored."""
+        with self.lock:
+            self._beat(worker_id)
+            self.leases.pop(lease, None)
+            self._check_done()
+
+    def solution(self, worker_id, item) -> bool:
+        """Report a solution. Returns whether the worker should stop."""
+        key = pickle.dumps(item)
+        with self.lock:
+            self._beat(worker_id)
+            new = key not in self.seen
+            self.seen.add(key)
+        if new:
+            self.exchange.put_solution(item)
+        return self.exchange.stopped()
+
+    def heartbeat(self, worker_id, nodes) -> dict:
+        """Report that a worker is alive and has explored nodes more nodes.
+        Returns a dict of "stop": whether it should stop, "share": how many
+        partials it should give() to idle workers, and "nodes_left" and
+        "time_left" of the budget and deadline (None without one)."""
+        with self.lock:
+            alive = self._beat(worker_id)
+            share = 0 if self.queue else len(self.hungry)
+        stop = self.exchange.charge(nodes) or not alive
+        ex = self.exchange
+        return {
+            "stop": stop,
+            "share": share,
+            "nodes_left": ex.max_nodes.value - ex.nodes.value if ex.max_nodes.value else None,
+            "time_left": ex.deadline.value - time.time() if ex.deadline.value else None,
+        }
+
+    def leave(self, worker_id, stats, items=()) -> None:
+        """Drop a worker out of the search, putting the partials it hasn't
+        explored (the rest of its leases) back on the queue."""
+        with self.lock:
+            if worker_id in self.workers:
+                del self.workers[worker_id]
+                self.hungry.discard(worker_id)
+                self.queue.extend(items)
+                for lease, (owner, _) in list(self.leases.items()):
+                    if owner == worker_id:
+                        del self.leases[lease]
+                self._check_done()
+                self.exchange.put_stats(stats)
+
+    def reap(self) -> None:
+        """Give up on workers that stopped calling in, requeueing their leases."""
+        now = time.time()
+        with self.lock:
+            for worker_id, last in list(self.workers.items()):
+                if now - last <= self.heartbeat_timeout:
+                    continue
+                del self.workers[worker_id]
+                self.hungry.discard(worker_id)
+                self.exchange.num_workers.value -= 1
+                for lease, (owner, items) in list(self.leases.items()):
+                    if owner == worker_id:
+                        del self.leases[lease]
+                        self.queue.extend(items)
+                        self.requeued += len(items)
+            self._check_done()
+
+
+class DistributedBacktracker(_ExchangeStatus):
+    """A Backtracker whose workers connect to it over TCP, so that one search
+    can use the processes of many hosts.
+
+    The search is served at address (a (host, port) pair, port 0 picking a
+    free one, see the address attribute) to workers started anywhere with
+    remote_worker(address, authkey), which get the search functions from
+    the coordinator. These (and encode and decode) must therefore be
+    picklable by reference: defined at the top level of a module the workers
+    can import. go() can also start local worker processes.
+
+    Workers lease partials batch_size at a time, call in every
+    heartbeat_interval seconds (see remote_worker()), and are given up for
+    dead after heartbeat_timeout seconds of silence, their leases being
+    handed to the others. Workers may come and go at any time.
+    The search is followed as for a Backtracker, though stats() only has
+    the stats of the workers that left cleanly.
+    """
+
+    def __init__(self, address=("127.0.0.1", 0), authkey=None, *, next_choice_func=None, starting_guesses: list = None, partial_checker=None, candidate_matcher=None, encode=None, decode=None, max_solutions=None, search_factory=None, max_nodes=None, timeout=None, partial_score=None, batch_size=16, heartbeat_timeout=10.0):
+        """authkey: bytes that workers must present to connect, by default the
+        authkey of this process (which only its children share).
+
+        The other arguments are those of Backtracker."""
+        if None in [next_choice_func, partial_checker]:
+            raise ValueError(
+                "Backtracking requires both next_choice_func and partial_checker!")
+        self.encode = encode if encode is not None else _identity
+        self.decode = decode if decode is not None else _identity
+        self.timeout = timeout
+        self.exchange = LocalExchange(num_workers=0)
+        self.exchange.max_solutions.value = max_solutions or 0
+        self.exchange.max_nodes.value = max_nodes or 0
+        job = {
+            "next_choice_func": next_choice_func,
+            "partial_checker": partial_checker,
+            "candidate_matcher": candidate_matcher,
+            "search_factory": search_factory,
+            "partial_score": partial_score,
+            "encode": self.encode,
+            "decode": self.decode,
+        }
+        self.coordinator = Coordinator(self.exchange, job, batch_size, heartbeat_timeout)
+        for s in starting_guesses:
+            for g in next_choice_func(s):
+                # the first choice is taken first
+                self.coordinator.queue.appendleft((1, self.encode(g)))
+        if authkey is None:
+            authkey = bytes(multiprocessing.current_process().authkey)
+        self.authkey = authkey
+        manager_class = type("CoordinatorManager", (CoordinatorManager,), {})
+        manager_class.register('coordinator', callable=lambda: self.coordinator)
+        self._server = manager_class(address=address, authkey=authkey).get_server()
+        # normally made by serve_forever(), which isn't used
+        self._server.stop_event = threading.Event()
+        self.address = self._server.address
+        self._closing = False
+        self.worker_stats = []
+        self.children = []
+
+    def go(self, numthreads=0):
+        """Start serving the search, and numthreads local worker processes."""
+        if self.timeout is not None:
+            self.exchange.deadline.value = time.time() + self.timeout
+        # fork before starting any threads
+        for _ in range(numthreads):
+            self.children.append(multiprocessing.Process(
+                target=remote_worker, args=(self.address, self.authkey), daemon=True))
+        for t in self.children:
+            t.start()
+        with self.coordinator.lock:
+            self.coordinator._check_done()
+        threading.Thread(target=self._accept, daemon=True).start()
+        threading.Thread(target=self._monitor, daemon=True).start()
+
+    def _accept(self):
+        # Server.accepter(), but returning once the server is closed
+        listener = self._server.listener
+        while not self._closing:
+            try:
+                c = listener.accept()
+            except (OSError, EOFError, multiprocessing.AuthenticationError):
+                continue
+            threading.Thread(target=self._server.handle_request, args=(c,), daemon=True).start()
+        listener.close()
+
+    def _monitor(self):
+        # workers only call in while they search, so dead ones and the
+        # deadline are looked after from here
+        interval = min(0.5, self.coordinator.heartbeat_timeout / 4)
+        ex = self.exchange
+        while not self._closing and not ex.stopped():
+            ex.wakeup.wait(interval)
+            self.coordinator.reap()
+            ex.charge(0)
+
+    def terminate(self, grace=1.0):
+        """Stop the search and stop serving it.
+        Workers are asked to stop and given grace seconds to leave before
+        the server closes. Local workers still running then are killed."""
+        self.exchange.halt("cancelled")
+        deadline = time.time() + grace
+        while self.coordinator.workers and time.time() < deadline:
+            time.sleep(0.01)
+        for t in self.children:
+            t.join(max(0, deadline - time.time()))
+        for t in self.children:
+            if t.is_alive():
+                t.terminate()
+                t.join()
+        if not self._closing:
+            self._closing = True
+            self._server.stop_event.set()
+            # wake the accepting thread up
+            host, port = self.address
+            try:
+                socket.create_connection((host if host not in ("", "0.0.0.0") else "127.0.0.1", port), 1).close()
+            except OSError:
+                pass
+
+
+def remote_worker(address, authkey, *, heartbeat_interval=1.0, poll_interval=0.05,
+                  connect_timeout=10.0, max_time=None):
+    """Work on the search served by a DistributedBacktracker at address,
+    until it is over or stopped, and return the SearchStats of this worker.
+
+    Calls in at least every heartbeat_interval seconds, giving back part
+    of its work when other workers are idle. Keeps trying to connect for
+    connect_timeout seconds. If max_time is given, it drops out of the
+    search after about that many seconds, handing back the work it has left."""
+    manager = WorkerManager(address=address, authkey=authkey)
+    give_up = time.time() + connect_timeout
+    while True:
+        try:
+            manager.connect()
+            break
+        except ConnectionRefusedError:
+            if time.time() >= give_up:
+                raise
+            time.sleep(poll_interval)
+    coordinator = manager.coordinator()
+    worker_id, job = coordinator.join()
+    encode, decode = job["encode"], job["decode"]
+    partial_score = job["partial_score"]
+    stats = SearchStats()
+    stack = deque()
+    lease = None
+    leave_at = None if max_time is None else time.time() + max_time
+    ti = time.perf_counter()
+
+    def found(partial):
+        return coordinator.solution(worker_id, encode(partial))
+    try:
+        reply = coordinator.heartbeat(worker_id, 0)
+        while not reply["stop"] and (leave_at is None or time.time() < leave_at):
+            if not stack:
+                if lease is not None:
+                    coordinator.done(worker_id, lease)
+                    lease = None
+                t0 = time.perf_counter()
+                taken = coordinator.take(worker_id)
+                if taken is None:
+                    break
+                if not taken:
+                    time.sleep(poll_interval)
+                    stats.idle_time += time.perf_counter() - t0
+                    continue
+                stats.queue_wait += time.perf_counter() - t0
+                lease, items = taken
+                stats.received += len(items)
+                stack.extend((d, decode(p)) for d, p in reversed(items))
+            before = stats.nodes
+            max_time_left = heartbeat_interval
+            if reply["time_left"] is not None:
+                max_time_left = max(0, min(max_time_left, reply["time_left"]))
+            if job["search_factory"] is not None:
+                _serial_subtrees(stack, job["search_factory"], stats, found,
+                                 max_nodes=reply["nodes_left"], max_time=max_time_left,
+                                 partial_score=partial_score)
+            else:
+                _serial_search(stack, job["next_choice_func"], job["partial_checker"],
+                               job["candidate_matcher"], stats, found,
+                               max_nodes=reply["nodes_left"], max_time=max_time_left,
+                               partial_score=partial_score)
+            reply = coordinator.heartbeat(worker_id, stats.nodes - before)
+            # hand the shallowest partials to idle workers
+            shared = []
+            while len(shared) < reply["share"] and len(stack) > 1:
+                depth, partial = stack.popleft()
+                shared.append((depth, encode(partial)))
+            if shared:
+                coordinator.give(worker_id, shared)
+                stats.donated += len(shared)
+    except (EOFError, ConnectionError):
+        # the coordinator has gone away
+        stats.elapsed = time.perf_counter() - ti
+        return stats
+    stats.elapsed = time.perf_counter() - ti
+    if stats.best is not None:
+        stats.best = encode(stats.best)
+    items = [(d, encode(p)) for d, p in stack] if not reply["stop"] else []
+    try:
+        coordinator.leave(worker_id, stats, items)
+    except (EOFError, ConnectionError):
+        pass
+    return stats
+
+
+def estimate_tree_size(starting_guesses, next_choice_func, partial_checker, *, probes=16,
+                       seed=None, max_depth=None) -> float:
+    """Estimate the number of nodes of the search tree below
+    starting_guesses (its roots, those passing partial_checker) with
+    Knuth's random probes.
+
+    A probe walks down the tree from a random root, taking a random child
+    that passes partial_checker at every level, until it reaches a leaf (or
+    max_depth). If the nodes along the way had d0 (the roots), d1, d2, ...
+    children, the tree has d0 + d0*d1 + d0*d1*d2 + ... nodes had every node
+    at the same depth as many children. That is an unbiased estimate; the
+    average of probes of them is returned. Irregular trees make it spread
+    widely, so only trust its order of magnitude. seed seeds the random
+    choices, for repeatable estimates."""
+    rng = random.Random(seed)
+    roots = [g for g in starting_guesses if partial_checker(g)]
+    if not roots or probes <= 0:
+        return 0.0
+    total = 0.0
+    for _ in range(probes):
+        width = len(roots)
+        size = width
+        node = rng.choice(roots)
+        depth = 0
+        while max_depth is None or depth < max_depth:
+            children = [g for g in next_choice_func(node) if partial_checker(g)]
+            if not children:
+                break
+            width *= len(children)
+            size += width
+            node = rng.choice(children)
+            depth += 1
+        total += size
+    return total / probes
+
+
+def split_frontier(items, target, next_choice_func, partial_checker, candidate_matcher,
+                   found=None, stats=None, estimate=None, max_nodes=None) -> list:
+    """Expand subproblems until there are at least target of them.
+
+    items are (depth, partial) pairs in the order they are to be explored.
+    Returns a new list of them in which the shallowest partial (or, if
+    estimate is given, the one with the largest estimate(partial) of the
+    size of its subtree) has been replaced by its children passing
+    partial_checker, over and over. With an estimate the list is then
+    sorted from the largest subtree down, so big ones aren't left for last.
+    Solutions met along the way are passed to found(partial), which returns
+    whether to stop. Stops early after max_nodes (4 * target by default)
+    expansions. If stats is a SearchStats it is added to."""
+    if stats is None:
+        stats = SearchStats()
+    if max_nodes is None:
+        max_nodes = 4 * target
+    ti = time.perf_counter()
+    items = list(items)
+    scores = None if estimate is None else [estimate(p) for _, p in items]
+    nodes = 0
+    while items and len(items) < target and nodes < max_nodes:
+        if scores is None:
+            i = min(range(len(items)), key=lambda k: items[k][0])
+        else:
+            i = max(range(len(items)), key=scores.__getitem__)
+        depth, partial = items[i]
+        nodes += 1
+        if depth > stats.max_depth:
+            stats.max_depth = depth
+        if candidate_matcher(partial):
+            stats.solutions += 1
+            if found is not None and found(partial):
+                del items[i]
+                break
+        guesses = list(next_choice_func(partial))
+        children = [(depth + 1, g) for g in guesses if partial_checker(g)]
+        stats.children += len(guesses)
+        stats.pruned += len(guesses) - len(children)
+        items[i:i + 1] = children
+        if scores is not None:
+            scores[i:i + 1] = [estimate(c) for _, c in children]
+    if scores is not None:
+        order = sorted(range(len(items)), key=lambda k: -scores[k])
+        items = [items[k] for k in order]
+    stats.nodes += nodes
+    stats.elapsed += time.perf_counter() - ti
+    return items
+
+
+def _serial_search(stack, next_choice_func, partial_checker, candidate_matcher, stats,
+                   found, max_nodes=None, max_time=None, partial_score=None) -> None:
+    """Search depth first from stack, a deque of (depth, partial) pairs,
+    calling found(partial) for every solution until it returns True.
+    Stops early after max_nodes nodes or max_time seconds, leaving the
+    unexplored partials on the stack. partial_score is as for backtrack()."""
+    clock = time.perf_counter
+    ti = clock()
+    deadline = None if max_time is None else ti + max_time
+    nodes = 0
+    while stack:
+        if max_nodes is not None and nodes >= max_nodes:
+            break
+        if deadline is not None and nodes % LIMIT_INTERVAL == 0 and clock() > deadline:
+            break
+        depth, partial = stack.pop()
+        nodes += 1
+        if partial_score is not None:
+            stats.consider(partial, partial_score(partial))
+        t0 = clock()
+        final = candidate_matcher(partial)
+        t1 = clock()
+        stats.check_time += t1 - t0
+        if depth > stats.max_depth:
+            stats.max_depth = depth
+        if final:
+            stats.solutions += 1
+            if found(partial):
+                break
+        guesses = list(next_choice_func(partial))
+        t2 = clock()
+        children = [g for g in guesses if partial_checker(g)]
+        stats.choice_time += t2 - t1
+        stats.check_time += clock() - t2
+        stats.children += len(guesses)
+        stats.pruned += len(guesses) - len(children)
+        depth += 1
+        stack.extend((depth, c) for c in reversed(children))
+        if len(stack) > stats.max_stack:
+            stats.max_stack = len(stack)
+    stats.nodes += nodes
+    stats.elapsed += clock() - ti
+
+
+def _search_counts(search) -> tuple:
+    """Return the counters of a search_factory search, for _add_counts()."""
+    return (search.nodes, search.children, search.pruned, getattr(search, "check_time", 0.0))
+
+
+def _add_counts(stats, search, before, depth, elapsed) -> None:
+    """Add what a search_factory search did in elapsed seconds since its
+    counters were before (see _search_counts()). The time its checks took,
+    if it keeps count, goes to check_time and the rest to choice_time."""
+    nodes, children, pruned, check_time = before
+    stats.nodes += search.nodes - nodes
+    stats.children += search.children - children
+    stats.pruned += search.pruned - pruned
+    checked = getattr(search, "check_time", 0.0) - check_time
+    stats.check_time += checked
+    stats.choice_time += elapsed - checked
+    if depth + search.max_depth > stats.max_depth:
+        stats.max_depth = depth + search.max_depth
+    if getattr(search, "max_stack", 0) > stats.max_stack:
+        stats.max_stack = search.max_stack
+
+
+def _consider_search(stats, search, partial_score) -> None:
+    """Offer the best partial of a search_factory search to stats."""
+    best = search.best() if partial_score is not None else None
+    if best is not None:
+        stats.consider(best, partial_score(best))
+
+
+def _serial_subtrees(stack, search_factory, stats, found, max_nodes=None, max_time=None,
+                     partial_score=None) -> None:
+    """_serial_search() with a search_factory (see backtrack()) exploring each
+    subtree in place. If a limit is reached, what is left of the subtree
+    being explored goes back on the stack."""
+    clock = time.perf_counter
+    ti = clock()
+    deadline = None if max_time is None else ti + max_time
+    nodes = 0
+    try:
+        while stack:
+            depth, partial = stack.pop()
+            search = search_factory(partial)
+            before = _search_counts(search)
+            while not search.finished:
+                if ((max_nodes is not None and nodes >= max_nodes) or
+                        (deadline is not None and clock() > deadline)):
+                    # splits come shallowest first, so the deepest ends up on top
+                    while True:
+                        item = search.split()
+                        if item is None:
+                            break
+                        stack.append((depth + item[0], item[1]))
+                    return
+                chunk = MAILBOX_INTERVAL if deadline is None else LIMIT_INTERVAL
+                if max_nodes is not None:
+                    chunk = min(chunk, max_nodes - nodes)
+                t0 = clock()
+                solutions = search.run(chunk)
+                nodes += search.nodes - before[0]
+                _add_counts(stats, search, before, depth, clock() - t0)
+                _consider_search(stats, search, partial_score)
+                before = _search_counts(search)
+                for partial in solutions:
+                    stats.solutions += 1
+                    if found(partial):
+                        return
+    finally:
+        stats.elapsed += clock() - ti
+
+
+def serial_backtrack(next_choice_func, *, starting_guesses, partial_checker, candidate_matcher, max_solutions=None, stats=None, search_factory=None, max_nodes=None, max_time=None, partial_score=None) -> list:
+    """Backtrack depth first in this process, with no workers to start or
+    talk to. Takes the same functions as backtrack(), but explores the
+    starting guesses themselves (those passing partial_checker) as roots.
+    Returns the solutions in the order found, stopping once max_solutions
+    have been found if given, or after max_nodes nodes or max_time seconds.
+    If stats is a SearchStats it is added to (with the best partial, if
+    partial_score is given). search_factory is as for backtrack()."""
+    if stats is None:
+        stats = SearchStats()
+    solutions = []
+
+    def found(partial):
+        solutions.append(partial)
+        return max_solutions is not None and len(solutions) >= max_solutions
+    stack = deque((0, g) for g in reversed(starting_guesses) if partial_checker(g))
+    if max_solutions == 0:
+        pass
+    elif search_factory is not None:
+        _serial_subtrees(stack, search_factory, stats, found, max_nodes, max_time, partial_score)
+    else:
+        _serial_search(stack, next_choice_func, partial_checker, candidate_matcher, stats, found,
+                       max_nodes, max_time, partial_score)
+    return solutions
+
+
 def worker_wrapper(*args, **kwargs):
     def worker():
         return backtrack(*args, **kwargs)
     return worker
 
 
-def backtrack(next_choice_func, *, partial_checker=None, candidate_matcher=None,  intermediate_queue=None, solutions_queue=None, mailbox=None, discard=None):
+def backtrack(next_choice_func, *, partial_checker=None, candidate_matcher=None,  intermediate_queue=None, solutions_queue=None, mailbox=None, discard=None, exchange=None, encode=_identity, decode=_identity, flush_on_stop=False, search_factory=None, partial_score=None):
     """next_choice_func should be a function that take a sequences and 
     returns any a list of all possible next items in that sequence.
     candidate_matcher should be a function that returns whether 
     Algorithm:
-    Instantiate a queue.
-    While it is not empty, pop all of its contents and put all the results
-    of the next_choice_func back into the queue.
-    Any results of the next_choice_func that match with the candidate_matcher 
+    Keep a local stack, seeded from the exchange (or intermediate_queue).
+    While it is not empty, pop the most recent partial and push all the
+    results of the next_choice_func that pass the partial_checker.
+    Any partials that match with the candidate_matcher 
     are put in a results queue.
-    The algorithm has finished when the queue is empty.
-    After that, the results queue is fed out.
+    When other workers are idle the oldest partial on the stack is handed
+    to them through the exchange, and when the local stack runs dry a new
+    one is taken from it.
+    Everything taken from or given to another process goes through
+    decode/encode.
+    The algorithm has finished when the exchange reports all work done,
+    or, without an exchange, when the local stack is empty.
+    Workers sharing an exchange also return as soon as its stop event is set.
+    Unless flush_on_stop is set (for workers that outlive the search), they
+    then give up on flushing their queues so their process can exit at once.
+    Returns the SearchStats of the search, which are also put on the
+    exchange if there is one.
+
+    search_factory is for problems where a subtree is explored much more
+    cheaply by changing a single partial solution in place and undoing the
+    changes than by creating every child with next_choice_func. For every
+    partial taken, search_factory(partial) returns a search that owns it:
+    an object with a finished attribute, counters nodes, children, pruned
+    and max_depth (and optionally check_time and max_stack, otherwise all
+    of its time counts as choice_time), and methods
+        run(max_nodes): explore up to max_nodes more nodes, returning the
+            solutions found (as partials that the search no longer changes);
+        split(): give up the shallowest unexplored subtree, returning
+            (depth below the search's root, partial) or None if there is none.
+    Only split() subtrees are handed to other workers, so partials are only
+    copied when work is shared. next_choice_func and the checkers are then
+    unused by the workers.
+
+    If the exchange has a node budget or a deadline, workers charge() the
+    nodes they explored to it every LIMIT_INTERVAL nodes, and it stops the
+    search once either has run out.
+
+    partial_score, if given, is a function scoring partial solutions: the
+    highest scoring one seen is kept (encoded) in the stats. Searches made
+    by search_factory then need a best() method returning a copy of the
+    partial furthest along they reached, or None.
     """
+    stats = SearchStats()
+    ti = time.perf_counter()
+    try:
+        _backtrack(next_choice_func, partial_checker, candidate_matcher, intermediate_queue,
+                   solutions_queue, mailbox, discard, exchange, encode, decode,
+                   flush_on_stop, stats, search_factory, partial_score)
+    finally:
+        stats.elapsed = time.perf_counter() - ti
+        if stats.best is not None:
+            stats.best = encode(stats.best)
+        if exchange is not None:
+            exchange.put_stats(stats)
+    return stats
+
+
+def _backtrack(next_choice_func, partial_checker, candidate_matcher, intermediate_queue,
+               solutions_queue, mailbox, discard, exchange, encode, decode,
+               flush_on_stop, stats, search_factory, partial_score):
+    """The search loop of backtrack(), keeping count in stats."""
     # signal.signal(signal.SIGINT, signal.SIG_IGN)
     paused = False
-    if intermediate_queue is None:
-        q = multiprocessing.Queue()
-    else:
-        q = intermediate_queue
-
     if solutions_queue is None:
         solutions = multiprocessing.Queue()
     else:
         solutions = solutions_queue
     assert not candidate_matcher is None, "A function to match final solutions must be provided."
 
-    while True:
-        # quit()
-        while not mailbox.empty():
-            v = q.get()
-            print("Received in inbox:", v)
-            if v == 1:
-                # return
-                quit()
-            elif v == 2:
-                paused = True
-            elif v == 3:
-                paused = False
-        if not paused:
+    # the stack holds (depth, partial) pairs
+    stack = deque()
+    if exchange is None and intermediate_queue is not None:
+        # no one to share with, just drain the queue and run serially
+        while True:
             try:
-                partial = q.get()
-                # print(partial)
-                # print("partial",partial)
-                if candidate_matcher(partial):
-                    # print(partial)
-                    solutions.put(partial)
-                for guess in next_choice_func(partial):
-                    if partial_checker(guess):
-                        q.put(guess)
-
-                    else:
-                        # print("BAD:",partial)
-                        if discard:
-                            discard.put(guess)
-                        pass
-                    # print(head)
+                stack.append((0, decode(intermediate_queue.get(timeout=0.1))))
             except queue.Empty:
-                pass
+                break
+
+    clock = time.perf_counter
+    nodes = 0
+    # nodes already charged to the exchange
+    charged = 0
+    next_mail = 0
+    limited = exchange is not None and bool(exchange.deadline.value or exchange.max_nodes.value)
+    # nodes explored between checks of the limits (or of the mailbox)
+    interval = LIMIT_INTERVAL if limited else MAILBOX_INTERVAL
+    next_check = 0
+    # the search_factory search in progress, if any
+    search = None
+    while True:
+        # quit()
+        if exchange is not None and exchange.stop.is_set():
+            if not flush_on_stop:
+                # nobody is going to read any work still buffered for the
+                # exchange, don't hang on exit trying to flush it
+                exchange.queue.cancel_join_thread()
+            return
+        if limited and nodes >= next_check:
+            next_check = nodes + interval
+            stopped = exchange.charge(nodes - charged)
+            charged = nodes
+            if stopped:
+                continue
+        if nodes >= next_mail or paused:
+            next_mail = nodes + MAILBOX_INTERVAL
+            while mailbox is not None and not mailbox.empty():
+                v = mailbox.get()
+                if v == 1:
+                    return
+                elif v == 2:
+                    paused = True
+                elif v == 3:
+                    paused = False
+        if paused:
+            time.sleep(0.01)
+            stats.idle_time += 0.01
+            continue
+        if search is not None:
+            before = _search_counts(search)
+            t0 = clock()
+            found = search.run(interval)
+            _add_counts(stats, search, before, search_depth, clock() - t0)
+            _consider_search(stats, search, partial_score)
+            nodes = stats.nodes
+            for partial in found:
+                stats.solutions += 1
+                if exchange is not None:
+                    exchange.put_solution(encode(partial))
+                else:
+                    solutions.put(encode(partial))
+            if search.finished:
+                search = None
+            elif exchange is not None:
+                # as many subtrees as there are idle workers
+                while exchange.wants_work():
+                    item = search.split()
+                    if item is None:
+                        break
+                    exchange.offer(encode(item[1]), search_depth + item[0])
+                    stats.donated += 1
+            continue
+        if not stack:
+            if exchange is None:
+                return
+            if limited and nodes > charged:
+                stopped = exchange.charge(nodes - charged)
+                charged = nodes
+                if stopped:
+                    continue
+            t0 = clock()
+            taken = exchange.take()
+            if taken is None:
+                stats.idle_time += clock() - t0
+                if exchange.stop.is_set():
+                    # clean up at the top of the loop
+                    continue
+                return
+            stats.queue_wait += clock() - t0
+            stats.received += 1
+            depth, partial = taken
+            partial = decode(partial)
+        else:
+            depth, partial = stack.pop()
+        if search_factory is not None:
+            search = search_factory(partial)
+            search_depth = depth
+            continue
+        # print("partial",partial)
+        nodes += 1
+        if partial_score is not None:
+            stats.consider(partial, partial_score(partial))
+        t0 = clock()
+        final = candidate_matcher(partial)
+        t1 = clock()
+        if final:
+            # print(partial)
+            stats.solutions += 1
+            if exchange is not None:
+                exchange.put_solution(encode(partial))
+            else:
+                solutions.put(encode(partial))
+        guesses = list(next_choice_func(partial))
+        t2 = clock()
+        children = []
+        for guess in guesses:
+            if partial_checker(guess):
+                children.append(guess)
+            else:
+                # print("BAD:",partial)
+                if discard:
+                    discard.put(guess)
+        t3 = clock()
+        stats.choice_time += t2 - t1
+        stats.check_time += (t1 - t0) + (t3 - t2)
+        stats.children += len(guesses)
+        stats.pruned += len(guesses) - len(children)
+        stats.nodes = nodes
+        if depth > stats.max_depth:
+            stats.max_depth = depth
+        # push in reverse so the first choice is explored first
+        depth += 1
+        stack.extend((depth, c) for c in reversed(children))
+        if len(stack) > stats.max_stack:
+            stats.max_stack = len(stack)
+        while exchange is not None and len(stack) > 1 and exchange.wants_work():
+            d, p = stack.popleft()
+            exchange.offer(encode(p), d)
+            stats.donated += 1
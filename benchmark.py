@@ -1,35 +1,427 @@
 #!/usr/bin/env python3
+"""Benchmarks for sudoku_solving.
+
+By default the solver engines are run over the puzzle corpora in corpus/
+and the latency percentiles and throughput of every corpus, engine and
+process count are written to a JSON file, optionally compared against
+the results of an earlier run. --micro runs the smaller benchmarks of
+individual parts of the solver instead, and --scaling measures what
+solving costs on each size of board."""
 import sudoku_solving
+import argparse
+import json
+import os
+import platform
+import sys
 import time
-import matplotlib.pyplot as plt
-
-
-def main():
-    test_results = {}
-    # for num_procs in [4,8,12,16,20,24,32]:
-    for num_procs in range(4, 32 + 1, 2):
-        test_results.update({num_procs: []})
-        print("Testing", num_procs, "process(es)")
-        for i in range(20):
-            s = list(map(
-                int, "800000000003600000070090200050007000000045700000100030001000068008500010090000400"))
-            # print("Start:")
-            # print(SudokuBoard(s))
-            # print("Solution:")
+import timeit
+import tracemalloc
+import pickle
+
+HARD_PUZZLE = "800000000003600000070090200050007000000045700000100030001000068008500010090000400"
+
+
+def board_ops_benchmark(number=2000):
+    """Time the board operations that dominate the search on the benchmark puzzle."""
+    b = sudoku_solving.board_from_string(HARD_PUZZLE)
+    ops = [
+        ("check_partial", b.check_partial),
+        ("candidates (all cells)", lambda: [b.candidates(x, y)
+                                            for y in range(b.size) for x in range(b.size)]),
+        ("populate", lambda: b.clone().populate()),
+        ("sudoku_next_choices", lambda: sudoku_solving.sudoku_next_choices(b)),
+    ]
+    for name, f in ops:
+        t = timeit.timeit(f, number=number) / number
+        print("{:>24}: {:9.2f} us".format(name, t * 1e6))
+
+
+def tree_size_benchmark(limit=1000000):
+    """Compare the number of search nodes needed by each branching strategy."""
+    for branching in sorted(sudoku_solving.BRANCHING_STRATEGIES):
+        b = sudoku_solving.board_from_string(HARD_PUZZLE)
+        ti = time.time()
+        solution, nodes = sudoku_solving.count_nodes(b, branching, limit=limit)
+        print("{:>6}: {:8d} nodes in {:.3f} seconds{}".format(
+            branching, nodes, time.time() - ti, "" if solution else " (no solution)"))
+
+
+def engine_benchmark(repeats=5, num_processes=4):
+    """Compare the solver engines on the benchmark puzzle."""
+    for engine in sudoku_solving.ENGINES:
+        times = []
+        for _ in range(repeats):
+            b = sudoku_solving.board_from_string(HARD_PUZZLE)
             ti = time.time()
-            sudoku_solving.solve_string(s, num_processes=num_procs)
-            tf = time.time()
-            print("\tDeltaT = ", tf - ti, "seconds")
-            test_results[num_procs].append(tf - ti)
-    for k, i in sorted(test_results.items(), key=lambda x: x[0]):
-        print(k, sum(i) / len(i))
-    with open("benchmarks.txt",'w') as f:
-        f.write(str(test_results))
+            sudoku_solving.solve_sudoku(b, num_processes=num_processes, engine=engine)
+            times.append(time.time() - ti)
+        print("{:>12}: {:.4f} seconds average".format(engine, sum(times) / len(times)))
+
+
+def wire_format_benchmark(number=5000):
+    """Compare pickling whole boards with the compact wire encoding.
+    This is what every partial solution costs to move between processes."""
+    b = sudoku_solving.sudoku_next_choices(sudoku_solving.board_from_string(HARD_PUZZLE))[0]
+    for name, encode, decode in [
+            ("pickled board", lambda x: x, lambda x: x),
+            ("wire format", sudoku_solving.encode_board, sudoku_solving.decode_board)]:
+        payload = pickle.dumps(encode(b))
+        t_enc = timeit.timeit(lambda: pickle.dumps(encode(b)), number=number) / number
+        t_dec = timeit.timeit(lambda: decode(pickle.loads(payload)), number=number) / number
+        print("{:>14}: {:6d} bytes/node, encode {:7.2f} us, decode {:7.2f} us".format(
+            name, len(payload), t_enc * 1e6, t_dec * 1e6))
+
+
+POOL_PUZZLES = [
+    HARD_PUZZLE,
+    "900100400007020080060000000400500200080090010003006000100700030005008900020000006",
+    "000000000000000000000000000000000000000000000000000000000000000000000000000000000",
+]
+
+
+def pool_benchmark(rounds=5, num_processes=4):
+    """Compare the per-puzzle latency of solve_sudoku(), which starts fresh
+    worker processes every time, with a persistent SolverPool."""
+    puzzles = [sudoku_solving.board_from_string(p) for p in POOL_PUZZLES] * rounds
+    ti = time.time()
+    for b in puzzles:
+        sudoku_solving.solve_sudoku(b, num_processes=num_processes)
+    fresh = (time.time() - ti) / len(puzzles)
+    ti = time.time()
+    with sudoku_solving.SolverPool(num_processes) as pool:
+        for b in puzzles:
+            pool.solve(b)
+    pooled = (time.time() - ti) / len(puzzles)
+    print("solve_sudoku: {:.4f} seconds/puzzle".format(fresh))
+    print("  SolverPool: {:.4f} seconds/puzzle (including pool startup)".format(pooled))
+
+
+def split_benchmark(num_processes=4, limit=0.5) -> list:
+    """Time solve_sudoku_report() on the hard corpus with no serial phase,
+    so that splitting the frontier for the workers solves most of the
+    puzzles before any worker starts. Those solves should cost no more
+    than the split itself: returns the puzzles that took over limit seconds."""
+    _, puzzles = load_corpus("hard")
+    slow = []
+    for i, p in enumerate(puzzles):
+        b = sudoku_solving.board_from_string(p)
+        report = sudoku_solving.solve_sudoku_report(b, num_processes=num_processes,
+                                                    serial_nodes=None, serial_time=None)
+        print("hard #{}: {:.4f} seconds, {} nodes, {} worker reports".format(
+            i, report.elapsed, report.nodes, report.stats.get("workers", 0)))
+        if report.elapsed > limit:
+            slow.append(p)
+    if slow:
+        print("{} puzzles took over {} seconds".format(len(slow), limit))
+    return slow
+
+
+def batch_benchmark(repeats=20, num_processes=4):
+    """Measure the throughput of solve_many() on whole puzzles."""
+    stats = {}
+    puzzles = POOL_PUZZLES * repeats
+    for _ in sudoku_solving.solve_many(puzzles, processes=num_processes, stats=stats):
+        pass
+    print("solve_many: {} puzzles at {:.1f} puzzles/second".format(
+        stats["solved"], stats["puzzles_per_second"]))
+
+
+def vectorized_benchmark(repeats=50):
+    """Compare singles propagation of the easy corpus in NumPy batches with
+    a populate() loop over the same boards, then the end to end throughput
+    of solve_many() with and without the vectorized engine."""
+    if not sudoku_solving.vectorized.available():
+        print("vectorized: numpy is not installed, skipping")
+        return
+    size, puzzles = load_corpus("easy")
+    puzzles = puzzles * repeats
+    boards = [sudoku_solving.board_from_string(p, size) for p in puzzles]
+    cells = [[v for r in b.rows for v in r] for b in boards]
+    ti = time.perf_counter()
+    for b in boards:
+        b.clone().populate(techniques=("naked_singles", "hidden_singles"))
+    loop = time.perf_counter() - ti
+    ti = time.perf_counter()
+    sudoku_solving.vectorized.propagate_batch(cells, size)
+    batch = time.perf_counter() - ti
+    print("propagation of {} boards: populate() {:.0f} puzzles/second, numpy {:.0f} puzzles/second".format(
+        len(boards), len(boards) / loop, len(boards) / batch))
+    for engine in ("backtracking", "vectorized"):
+        stats = {}
+        for _ in sudoku_solving.solve_many(puzzles, processes=1, engine=engine, stats=stats):
+            pass
+        print("solve_many engine={}: {:.1f} puzzles/second".format(engine, stats["puzzles_per_second"]))
+
+
+def generator_benchmark(count=20, clues=30, num_processes=4):
+    """Measure puzzle generation throughput at a given clue count, then of
+    9x9 puzzles at every level of difficulty."""
+    for size in (4, 9):
+        ti = time.time()
+        for _ in sudoku_solving.generate_puzzles(count, size=size, clues=clues if size == 9 else None,
+                                                 processes=num_processes):
+            pass
+        dt = time.time() - ti
+        print("{0}x{0}: {1:.1f} puzzles/minute".format(size, count / dt * 60))
+    for level in sudoku_solving.DIFFICULTY_LEVELS:
+        ti = time.time()
+        for _ in sudoku_solving.generate_puzzles(count, difficulty=level, processes=num_processes):
+            pass
+        dt = time.time() - ti
+        print("9x9 {}: {:.1f} puzzles/minute".format(level, count / dt * 60))
+
+
+CORPUS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "corpus")
+CORPORA = ("easy", "hard", "16x16", "25x25", "36x36", "49x49", "64x64")
+# one corpus of each board size, for scaling_benchmark(). Their clue densities
+# differ, and from 36x36 up the puzzles may have several solutions (see the
+# corpus headers), so their solve times don't show a trend with size
+SCALING_CORPORA = ("hard", "16x16", "25x25", "36x36", "49x49", "64x64")
+# engines of the suite: "serial" is propagation plus depth first search in
+# this process, the others are passed to solve_sudoku()
+SUITE_ENGINES = ("serial", "dlx", "backtracking")
+
+
+def load_corpus(name) -> tuple:
+    """Return (size, puzzle strings) of a corpus in CORPUS_DIR.
+    Lines starting with # are comments, and "# size: N" gives the board size."""
+    size = 9
+    puzzles = []
+    with open(os.path.join(CORPUS_DIR, name + ".txt")) as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith("# size:"):
+                size = int(line.split(":")[1])
+            elif line and not line.startswith("#"):
+                puzzles.append(line)
+    return size, puzzles
+
+
+def percentile(sorted_values, p):
+    """Return the pth percentile (nearest rank) of a sorted list."""
+    rank = max(0, min(len(sorted_values) - 1, int(round(p / 100 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[rank]
+
+
+def time_solve(board, engine, num_processes) -> tuple:
+    """Solve board once, returning (seconds, search nodes). Nodes are what
+    each engine counts: boards for "serial" and "backtracking" (none if
+    propagation alone solves the puzzle), exact cover rows tried for "dlx"."""
+    ti = time.perf_counter()
+    if engine == "serial":
+        solution, nodes = sudoku_solving.count_nodes(board)
+    else:
+        stats = {}
+        solution = sudoku_solving.solve_sudoku(board, num_processes=num_processes, engine=engine,
+                                               stats=stats)
+        nodes = stats.get("nodes", 0)
+    dt = time.perf_counter() - ti
+    if solution is None or not solution.check():
+        raise RuntimeError("{} failed to solve {}".format(engine, board.serialize()))
+    return dt, nodes
+
+
+def summarize(times, nodes) -> dict:
+    """Return the statistics of the solve times of a run."""
+    ordered = sorted(times)
+    total = sum(times)
+    out = {
+        "puzzles": len(times),
+        "total": total,
+        "mean": total / len(times),
+        "median": percentile(ordered, 50),
+        "p95": percentile(ordered, 95),
+        "p99": percentile(ordered, 99),
+        "puzzles_per_second": len(times) / total if total else None,
+        "nodes": sum(nodes),
+        "nodes_per_second": sum(nodes) / total if total else None,
+    }
+    return out
+
+
+def run_suite(corpora, engines, processes, repeat=3, warmup=1, log=print) -> dict:
+    """Benchmark every combination of corpus, engine and process count.
+    Every puzzle is solved warmup times untimed, then repeat times timed.
+    Returns the results keyed by "corpus/engine/processes"."""
+    results = {}
+    for corpus in corpora:
+        size, puzzles = load_corpus(corpus)
+        boards = [sudoku_solving.board_from_string(p, size) for p in puzzles]
+        for engine in engines:
+            # only the backtracking engine uses more than one process
+            for num_processes in (processes if engine == "backtracking" else [1]):
+                key = "{}/{}/{}".format(corpus, engine, num_processes)
+                times = []
+                nodes = []
+                for b in boards:
+                    for _ in range(warmup):
+                        time_solve(b, engine, num_processes)
+                    for _ in range(repeat):
+                        dt, n = time_solve(b, engine, num_processes)
+                        times.append(dt)
+                        nodes.append(n)
+                results[key] = summarize(times, nodes)
+                log("{:<28} median {:9.4f}s  p95 {:9.4f}s  p99 {:9.4f}s  {:9.1f} puzzles/s  "
+                    "{:9.1f} nodes/s".format(
+                        key, results[key]["median"], results[key]["p95"], results[key]["p99"],
+                        results[key]["puzzles_per_second"], results[key]["nodes_per_second"]))
+    return results
+
+
+def environment() -> dict:
+    """Describe the machine the benchmarks ran on."""
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+
+
+def compare(results, baseline, threshold=0.2) -> list:
+    """Return descriptions of the results that are more than threshold
+    (a fraction) slower than the baseline results."""
+    regressions = []
+    for key, new in sorted(results.items()):
+        old = baseline.get(key)
+        if old is None:
+            continue
+        for metric in ("median", "p95"):
+            if old[metric] and new[metric] > old[metric] * (1 + threshold):
+                regressions.append("{} {}: {:.4f}s -> {:.4f}s (+{:.0f}%)".format(
+                    key, metric, old[metric], new[metric], (new[metric] / old[metric] - 1) * 100))
+    return regressions
+
+
+def plot(results, path):
+    """Save a chart of median latency against process count to path.
+    Needs matplotlib, which is used without a display."""
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
     plt.figure()
-    xs, ys = list(zip(*sorted(test_results.items(), key=lambda x: x[0])))
-    ys = [sum(i)/len(i) for i in ys]
-    plt.plot(xs,ys) 
-    plt.show()
+    series = {}
+    for key, r in results.items():
+        corpus, engine, num_processes = key.split("/")
+        if engine == "backtracking":
+            series.setdefault(corpus, []).append((int(num_processes), r["median"]))
+    for corpus, points in sorted(series.items()):
+        xs, ys = zip(*sorted(points))
+        plt.plot(xs, ys, marker="o", label=corpus)
+    plt.xlabel("processes")
+    plt.ylabel("median seconds")
+    plt.legend()
+    plt.savefig(path)
+
+
+def scaling_benchmark(corpora=SCALING_CORPORA, count=2, log=print) -> dict:
+    """Measure what solving costs on each size of board, using the first
+    count puzzles of corpora of increasing size: their clue density, the
+    median time of a serial solve (see count_nodes()), the time per search
+    node, the peak memory of a solve as traced by tracemalloc, and what one
+    board costs to copy and to send to another process. Returns the results
+    keyed by size.
+
+    The corpora aren't matched for difficulty (see SCALING_CORPORA): the
+    per node, memory and board costs compare across sizes, the solve times
+    and node counts only with the clue density next to them."""
+    results = {}
+    log("{:>5} {:>7} {:>10} {:>8} {:>10} {:>10} {:>8} {:>9}".format(
+        "size", "clues", "median s", "nodes", "us/node", "peak KiB", "wire B", "clone us"))
+    for corpus in corpora:
+        size, puzzles = load_corpus(corpus)
+        boards = [sudoku_solving.board_from_string(p, size) for p in puzzles[:count]]
+        times = []
+        nodes = []
+        peaks = []
+        for b in boards:
+            dt, n = time_solve(b, "serial", 1)
+            times.append(dt)
+            nodes.append(n)
+            # separately, as tracing slows everything down
+            tracemalloc.start()
+            sudoku_solving.count_nodes(b)
+            peaks.append(tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+        b = boards[0].clone()
+        b.populate()
+        clone = min(timeit.repeat(b.clone, number=100, repeat=3)) / 100
+        clues = sum(1 for board in boards for row in board.rows for v in row if v)
+        r = {
+            "clue_density": clues / (size * size * len(boards)),
+            "median": percentile(sorted(times), 50),
+            "nodes": percentile(sorted(nodes), 50),
+            "seconds_per_node": sum(times) / sum(nodes),
+            "peak_bytes": max(peaks),
+            "wire_bytes": len(sudoku_solving.encode_board(b)),
+            "clone_seconds": clone,
+        }
+        results[size] = r
+        log("{:>5} {:>6.0%} {:>10.4f} {:>8} {:>10.1f} {:>10.1f} {:>8} {:>9.1f}".format(
+            size, r["clue_density"], r["median"], r["nodes"], r["seconds_per_node"] * 1e6,
+            r["peak_bytes"] / 1024, r["wire_bytes"], r["clone_seconds"] * 1e6))
+    return results
+
+
+def micro_benchmarks():
+    board_ops_benchmark()
+    wire_format_benchmark()
+    tree_size_benchmark()
+    engine_benchmark()
+    pool_benchmark()
+    split_benchmark()
+    batch_benchmark()
+    vectorized_benchmark()
+    generator_benchmark()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the sudoku_solving engines.")
+    parser.add_argument("--corpus", default="easy,hard,16x16",
+                        help="Comma separated corpora to run, from: " + ", ".join(CORPORA))
+    parser.add_argument("--engines", default=",".join(SUITE_ENGINES),
+                        help="Comma separated engines to run, from: " + ", ".join(SUITE_ENGINES))
+    parser.add_argument("--processes", default="1,2,4",
+                        help="Comma separated process counts for the backtracking engine.")
+    parser.add_argument("--repeat", type=int, default=3, help="Timed solves per puzzle.")
+    parser.add_argument("--warmup", type=int, default=1, help="Untimed solves per puzzle.")
+    parser.add_argument("--output", default="benchmarks.json", help="Where to write the results.")
+    parser.add_argument("--baseline", help="Earlier results to compare against.")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="Slowdown (a fraction) that counts as a regression.")
+    parser.add_argument("--plot", metavar="PNG", help="Also save a chart of the results.")
+    parser.add_argument("--micro", action="store_true", help="Run the micro benchmarks instead.")
+    parser.add_argument("--scaling", action="store_true",
+                        help="Measure solving costs on each board size instead, "
+                        "writing the results to --output. Solve times are next to the "
+                        "clue density of each corpus, which differs between sizes.")
+    args = parser.parse_args(argv)
+    if args.micro:
+        micro_benchmarks()
+        return 0
+    if args.scaling:
+        results = scaling_benchmark()
+        with open(args.output, "w") as f:
+            json.dump({"environment": environment(), "scaling": results}, f, indent=2, sort_keys=True)
+        return 0
+    results = run_suite(args.corpus.split(","), args.engines.split(","),
+                        [int(p) for p in args.processes.split(",")],
+                        repeat=args.repeat, warmup=args.warmup)
+    with open(args.output, "w") as f:
+        json.dump({"environment": environment(), "results": results}, f, indent=2, sort_keys=True)
+    if args.plot:
+        plot(results, args.plot)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+        regressions = compare(results, baseline, args.threshold)
+        for r in regressions:
+            print("REGRESSION", r)
+        if regressions:
+            return 1
+        print("No regressions against", args.baseline)
+    return 0
+
 
 if __name__ == '__main__':
-    main()
+    sys.exit(main())
@@ -25,5 +25,6 @@ setup(
     scripts=["bin/sudoku_solving"],
 
     install_requires=[],
+    extras_require={"vectorized": ["numpy"]},
     zip_safe=True
 )
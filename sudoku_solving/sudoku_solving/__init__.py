@@ -5,11 +5,33 @@ Any functions involving a board should be aware of this."""
 import sys
 sys.path.append('backtracking/')
 import backtracking
+if sys.platform in ["win32"]:
+    import multiprocess as multiprocessing
+else:
+    import multiprocessing
+import queue
 import time
 import os
 import signal
-import copy
 import argparse
+import array
+import csv
+import functools
+import struct
+import threading
+import itertools
+import json
+import math
+import asyncio
+import atexit
+import concurrent.futures
+import weakref
+from collections import deque
+from . import dlx
+from . import generator
+from . import canonical
+from . import vectorized
+from .canonical import SolutionCache
 
 
 class UserRequestedQuit(Exception):
@@ -21,6 +43,10 @@ class SudokuBoard():
 
     """Handle a Sudoku board and various bits of information needed to solve it."""
 
+    __slots__ = ("size", "root", "square", "original", "serialized", "rows", "rownums",
+                 "row_masks", "col_masks", "quad_masks", "excluded", "num_empty", "_valid",
+                 "trail", "quads", "full")
+
     def __init__(self, serialized, size=9):
         self.size = size
         self.root = int(size**(1 / 2))
@@ -39,22 +65,102 @@ class SudokuBoard():
         self.rows = []
         self.rows = sublists(self.serialized, size)
         self.rownums = list(range(self.size))
+        # changes recorded for undo(), see start_trail()
+        self.trail = None
+        # per-size constants shared by every board of that size
+        self.quads = board_quadrants(size)
+        self.full = full_mask(size)
+        self.rebuild_masks()
+
+    def rebuild_masks(self) -> None:
+        """Recompute the used-digit bitmasks of every row, column and quadrant.
+        Bit d-1 of a mask is set when digit d is present in that unit.
+        Also recounts the empty cells and forgets any cached validity
+        and eliminated candidates."""
+        self.row_masks = [0] * self.size
+        self.col_masks = [0] * self.size
+        self.quad_masks = [0] * self.size
+        # per-cell masks of candidates ruled out by propagation,
+        # None until something has been eliminated
+        self.excluded = None
+        self.num_empty = 0
+        self._valid = None
+        for y, row in enumerate(self.rows):
+            for x, v in enumerate(row):
+                if v == 0:
+                    self.num_empty += 1
+                else:
+                    bit = 1 << (v - 1)
+                    self.row_masks[y] |= bit
+                    self.col_masks[x] |= bit
+                    self.quad_masks[self.quadrant_index(x, y)] |= bit
 
     def clone(self):
-        """Clone self, a deep copy."""
-        other = SudokuBoard(self.serialized[:], self.size)
+        """Clone self, a deep copy.
+        original and serialized, the board as it was created, are never
+        modified and so are shared. The trail is not copied."""
+        other = SudokuBoard.__new__(SudokuBoard)
         other.size = self.size
         other.root = self.root
         other.square = self.square
-        other.original = copy.deepcopy(self.original)
-        other.serialized = copy.deepcopy(self.serialized)
-        other.rows = copy.deepcopy(self.rows)
-        other.rownums = copy.deepcopy(self.rownums)
+        other.original = self.original
+        other.serialized = self.serialized
+        other.rows = [r[:] for r in self.rows]
+        other.rownums = self.rownums[:]
+        other.row_masks = self.row_masks[:]
+        other.col_masks = self.col_masks[:]
+        other.quad_masks = self.quad_masks[:]
+        if self.excluded is not None:
+            other.excluded = [r[:] for r in self.excluded]
+        else:
+            other.excluded = None
+        other.num_empty = self.num_empty
+        other._valid = self._valid
+        other.trail = None
+        other.quads = self.quads
+        other.full = self.full
+        return other
+
+    def start_trail(self) -> None:
+        """Record every following set() of an empty cell and eliminate() so
+        that they can be taken back with undo(), letting a search explore
+        many boards without copying any. While trailing, filled cells can't
+        be changed."""
+        self.trail = []
+
+    def mark(self) -> tuple:
+        """Return the current position in the trail, for undo()."""
+        return (len(self.trail), self._valid, self.num_empty)
+
+    def undo(self, mark) -> None:
+        """Take back every change recorded since mark() returned mark."""
+        length, self._valid, self.num_empty = mark
+        self._undo_into(self, length)
+        del self.trail[length:]
+
+    def _undo_into(self, board, length) -> None:
+        """Apply the inverse of the trail entries past length to board."""
+        for entry in reversed(self.trail[length:]):
+            if len(entry) == 3:
+                x, y, excluded = entry
+                board.excluded[y][x] = excluded
+            else:
+                x, y, row_mask, col_mask, quad_mask = entry
+                board.rows[y][x] = 0
+                board.row_masks[y] = row_mask
+                board.col_masks[x] = col_mask
+                board.quad_masks[self.quadrant_index(x, y)] = quad_mask
+
+    def clone_at(self, mark):
+        """Return a copy of the board as it was at mark, leaving self as it is."""
+        other = self.clone()
+        length, other._valid, other.num_empty = mark
+        self._undo_into(other, length)
         return other
 
     def check(self) -> bool:
         """Return whether the board is solved."""
-        return (self.next_empty() is None) and self.check_partial()
+        return self.num_empty == 0 and self.check_partial()
 
     def quadrant(self, n) -> list:
         """Return a list of all cells in the nth quadrant, start fomr the top left
@@ -67,12 +173,53 @@ class SudokuBoard():
             sq.extend(row[col_offset: col_offset + self.root])
         return sq
 
+    def quadrant_index(self, x, y) -> int:
+        """Return the number of the quadrant containing cell x,y."""
+        return self.quads[y][x]
+
     def get(self, x, y) -> int:
         """Get value of cell at x,y"""
         return self.rows[y][x]
 
     def set(self, n, x, y):
+        """Set cell at x,y to n, keeping the unit bitmasks, the empty cell
+        count and the cached validity up to date."""
+        old = self.rows[y][x]
+        if self.trail is not None:
+            if old != 0:
+                raise ValueError("Filled cells can't be changed while trailing.")
+            self.trail.append((x, y, self.row_masks[y], self.col_masks[x],
+                               self.quad_masks[self.quadrant_index(x, y)]))
         self.rows[y][x] = n
+        if old != 0:
+            # the old digit may still be present elsewhere in these units,
+            # so they have to be rescanned rather than simply cleared
+            self._rescan_units(x, y)
+            if n == 0:
+                self.num_empty += 1
+            self._valid = None
+            # eliminations may have depended on the old digit
+            self.excluded = None
+        elif n != 0:
+            self.num_empty -= 1
+            bit = 1 << (n - 1)
+            q = self.quadrant_index(x, y)
+            if (self.row_masks[y] | self.col_masks[x] | self.quad_masks[q]) & bit:
+                self._valid = False
+            self.row_masks[y] |= bit
+            self.col_masks[x] |= bit
+            self.quad_masks[q] |= bit
+            if self._valid:
+                # only the cells sharing a unit with x,y can have lost their
+                # last candidate
+                self._valid = not self._starves_peers(x, y)
+
+    def _rescan_units(self, x, y):
+        """Recompute the bitmasks of the row, column and quadrant of cell x,y."""
+        q = self.quadrant_index(x, y)
+        self.row_masks[y] = digits_to_mask(self.row(y))
+        self.col_masks[x] = digits_to_mask(self.col(x))
+        self.quad_masks[q] = digits_to_mask(self.quadrant(q))
 
     def row(self, y) -> list:
         """Return a list of all cells in the nth row."""
@@ -82,42 +229,82 @@ class SudokuBoard():
         """Return a lsit of all cells in the nth column."""
         return [self.rows[i][x] for i in range(self.size)]
 
-    def check_partial(self) -> bool:
-        """Return whether the board does not violate any rules."""
+    def _starves_peers(self, x, y) -> bool:
+        """Return whether any empty cell sharing a unit with x,y has no candidates."""
         for i in range(self.size):
-            if invalid_set(self.row(i)) or invalid_set(self.col(i)) or invalid_set(self.quadrant(i)):
-                # print("invalid row", row)
-                return False
-        for i in range(self.square):
-            # check for any empty cells with 0 candidates
-            x, y = lin_to_xy(i, self.size)
-            z = self.get(x, y)
-            if len(self.candidates(x, y)) == 0 and z == 0:
+            if self.rows[y][i] == 0 and self.candidate_mask(i, y) == 0:
+                return True
+            if self.rows[i][x] == 0 and self.candidate_mask(x, i) == 0:
+                return True
+        xmin = x - x % self.root
+        ymin = y - y % self.root
+        for j in range(ymin, ymin + self.root):
+            for i in range(xmin, xmin + self.root):
+                if self.rows[j][i] == 0 and self.candidate_mask(i, j) == 0:
+                    return True
+        return False
+
+    def check_partial(self) -> bool:
+        """Return whether the board does not violate any rules.
+        The result is cached and kept up to date by set(), so repeated checks
+        of the same board are free."""
+        if self._valid is None:
+            self._valid = self._validate()
+        return self._valid
+
+    def _validate(self) -> bool:
+        """Scan the whole board for rule violations and dead-end cells.
+        A unit repeats a digit when it has more filled cells than bits in
+        its mask."""
+        col_counts = [0] * self.size
+        quad_counts = [0] * self.size
+        for y, row in enumerate(self.rows):
+            filled = 0
+            for x, v in enumerate(row):
+                if v != 0:
+                    filled += 1
+                    col_counts[x] += 1
+                    quad_counts[self.quads[y][x]] += 1
+                elif self.candidate_mask(x, y) == 0:
+                    # an empty cell with 0 candidates
+                    return False
+            if filled != popcount(self.row_masks[y]):
                 return False
+        for masks, counts in ((self.col_masks, col_counts), (self.quad_masks, quad_counts)):
+            for m, n in zip(masks, counts):
+                if n != popcount(m):
+                    return False
+        return True
 
+    def candidate_mask(self, x, y) -> int:
+        """Get the bitmask of digits that could be filled into the cell at x,y.
+        Bit d-1 is set when digit d is a candidate."""
+        cur = self.rows[y][x]
+        if cur != 0:
+            return 1 << (cur - 1)
+        used = self.row_masks[y] | self.col_masks[x] | self.quad_masks[self.quads[y][x]]
+        if self.excluded is not None:
+            used |= self.excluded[y][x]
+        return ~used & self.full
+
+    def eliminate(self, mask, x, y) -> bool:
+        """Rule out the digits in mask as candidates of the empty cell at x,y.
+        Returns whether any candidates were removed."""
+        cur = self.candidate_mask(x, y)
+        if self.rows[y][x] != 0 or cur & mask == 0:
+            return False
+        if self.excluded is None:
+            self.excluded = [[0] * self.size for _ in range(self.size)]
+        if self.trail is not None:
+            self.trail.append((x, y, self.excluded[y][x]))
+        self.excluded[y][x] |= mask
+        if cur & ~mask == 0:
+            self._valid = False
         return True
 
     def candidates(self, x, y) -> set:
         """Get the set of possible digits that could be filled into cell at x,y"""
-        cur = self.get(x, y)
-        if cur != 0:
-            return set([cur])
-        ns = []
-        # horizontal line
-        ns.extend(self.row(y))
-        # vertical line
-        ns.extend(self.col(x))
-        xmin = self.root * (x // self.root)
-        xmax = xmin + self.root
-        ymin = self.root * (y // self.root)
-        ymax = ymin + self.root
-        for x in range(xmin, xmax):
-            for y in range(ymin, ymax):
-                ns.append(self.rows[y][x])
-        # ns.extend(self.rows[y][x] for x in range(xmin, xmax) for y in
-        # range(ymin, ymax)  )
-
-        return all_digits(self.size) - set(ns) - set([0])
+        return set(mask_to_digits(self.candidate_mask(x, y)))
 
     def next_empty(self) -> tuple:
         """Return xy coords of next empty cell, None if there are none."""
@@ -129,22 +316,25 @@ class SudokuBoard():
         return None
         # raise ValueError("No empty spaces on board.")
 
-    def populate(self, max_depth=None) -> int:
+    def populate(self, max_depth=None, techniques=None) -> int:
         """Fill in all the freebies.
-        Returns the number of freebies filled in."""
+        Returns the number of freebies filled in.
+
+        By default this runs the constraint propagation engine (see propagate())
+        to a fixpoint. Passing max_depth instead performs at most that many
+        sweeps of naked singles over the board."""
         if max_depth is None:
-            max_depth = -1
+            return self.propagate(techniques)
         outsum = 0
         while max_depth != 0:
             delta = 0
-            for i in range(self.square):
-                x, y = lin_to_xy(i, self.size)
-                cur = self.get(x, y)
-                if cur == 0:
-                    cs = self.candidates(x, y)
-                    if len(cs) == 1:
-                        self.set(cs.pop(), x, y)
-                        delta += 1
+            for y, row in enumerate(self.rows):
+                for x, cur in enumerate(row):
+                    if cur == 0:
+                        m = self.candidate_mask(x, y)
+                        if m != 0 and m & (m - 1) == 0:
+                            self.set(m.bit_length(), x, y)
+                            delta += 1
             outsum += delta
             max_depth -= 1
             if delta == 0:
@@ -152,29 +342,202 @@ class SudokuBoard():
 
         return outsum
 
+    def propagate(self, techniques=None, cells=None) -> int:
+        """Apply logical solving techniques until nothing more can be deduced.
+        techniques is a subset of PROPAGATION_TECHNIQUES, all of them by default.
+
+        Units (rows, columns and quadrants) are processed from a work queue and
+        a unit is only queued again when the candidates of one of its cells
+        change. If cells, a list of (x, y), is given only their units are
+        queued to begin with: the rest of the board must be propagated
+        already, as it is after assign().
+        Stops early if a contradiction is found, in which case check_partial()
+        will be False. Returns the number of cells filled in."""
+        if techniques is None:
+            techniques = PROPAGATION_TECHNIQUES
+        if not self.check_partial():
+            return 0
+        units, cell_units = board_units(self.size)
+        if cells is None:
+            work = deque(range(len(units)))
+            queued = [True] * len(units)
+            changed = []
+        else:
+            work = deque()
+            queued = [False] * len(units)
+            changed = cells
+        filled = 0
+        while True:
+            for x, y in changed:
+                for v in cell_units[y][x]:
+                    if not queued[v]:
+                        queued[v] = True
+                        work.append(v)
+            if not work:
+                break
+            u = work.popleft()
+            queued[u] = False
+            changed = []
+            filled += self._propagate_unit(u, units[u], techniques, changed)
+            if not self._valid:
+                break
+        return filled
+
+    def assign(self, n, x, y, techniques=None) -> int:
+        """Set the empty cell x,y to n and propagate the consequences.
+        The rest of the board must be propagated already (see propagate()),
+        which lets this look at only the units whose candidates change
+        instead of the whole board, a big saving on big boards.
+        Returns the number of cells filled in by propagation."""
+        changed = []
+        self._place(n, x, y, changed)
+        return self.propagate(techniques, changed)
+
+    def _place(self, n, x, y, changed) -> None:
+        """Set the empty cell x,y to n, appending to changed the cell and
+        every empty peer that loses n as a candidate."""
+        bit = 1 << (n - 1)
+        for i, j in board_peers(self.size)[y][x]:
+            if self.rows[j][i] == 0 and self.candidate_mask(i, j) & bit:
+                changed.append((i, j))
+        self.set(n, x, y)
+        changed.append((x, y))
+
+    def _propagate_unit(self, u, cells, techniques, changed) -> int:
+        """Apply techniques to a single unit, appending the cells whose
+        candidates changed to changed. Returns the number of cells filled in."""
+        filled = 0
+        if "naked_singles" in techniques:
+            for x, y in cells:
+                if self.rows[y][x] == 0:
+                    m = self.candidate_mask(x, y)
+                    if m & (m - 1) == 0:
+                        if m == 0:
+                            self._valid = False
+                            return filled
+                        self._place(m.bit_length(), x, y, changed)
+                        filled += 1
+                        if not self._valid:
+                            return filled
+        if "hidden_singles" in techniques:
+            while True:
+                empties = self._empties(cells)
+                once = more = placed = 0
+                for x, y in cells:
+                    if self.rows[y][x] != 0:
+                        placed |= 1 << (self.rows[y][x] - 1)
+                for _, _, m in empties:
+                    more |= once & m
+                    once |= m
+                if (placed | once) != self.full:
+                    # some digit has nowhere to go
+                    self._valid = False
+                    return filled
+                hidden = once & ~more
+                if hidden == 0:
+                    break
+                for x, y, m in empties:
+                    if m & hidden:
+                        self._place((m & hidden).bit_length(), x, y, changed)
+                        filled += 1
+                        break
+                if not self._valid:
+                    return filled
+        if "naked_subsets" in techniques:
+            self._naked_subsets(cells, changed)
+            if not self._valid:
+                return filled
+        if "intersections" in techniques:
+            self._intersections(u, cells, changed)
+        return filled
+
+    def _naked_subsets(self, cells, changed, max_size=3) -> None:
+        """Naked pairs and triples: k cells of a unit whose candidates together
+        are only k digits take those digits from the rest of the unit."""
+        empties = self._empties(cells)
+        for k in range(2, max_size + 1):
+            if len(empties) <= k:
+                break
+            small = [e for e in empties if popcount(e[2]) <= k]
+            for combo in itertools.combinations(small, k):
+                union = 0
+                for _, _, m in combo:
+                    union |= m
+                count = popcount(union)
+                if count < k:
+                    self._valid = False
+                    return
+                if count > k:
+                    continue
+                for x, y, m in empties:
+                    if (x, y, m) not in combo and self.eliminate(union, x, y):
+                        changed.append((x, y))
+                        if not self._valid:
+                            return
+            # the candidates may have changed, start from fresh masks
+            empties = self._empties(cells)
+
+    def _intersections(self, u, cells, changed) -> None:
+        """Pointing and box/line reduction: if within one unit a digit is
+        confined to the intersection with another unit, it can be removed from
+        the rest of that other unit.
+        Works on the candidate masks of whole intersections at once, so the
+        cost grows with the number of cells rather than cells times digits."""
+        candidates = {(x, y): m for x, y, m in self._empties(cells)}
+        for partition in board_intersections(self.size)[u]:
+            masks = []
+            once = more = 0
+            for segment, _ in partition:
+                m = 0
+                for c in segment:
+                    m |= candidates.get(c, 0)
+                masks.append(m)
+                more |= once & m
+                once |= m
+            for m, (_, outside) in zip(masks, partition):
+                # the digits of this segment found in no other segment
+                confined = m & ~more
+                if confined == 0:
+                    continue
+                for x, y in outside:
+                    if self.eliminate(confined, x, y):
+                        changed.append((x, y))
+                        if not self._valid:
+                            return
+
+    def _empties(self, cells) -> list:
+        """Return (x, y, candidate mask) of the empty cells among cells.
+        The same as calling candidate_mask() on each, but cheaper."""
+        rows, row_masks, col_masks, quad_masks, quads, excluded = (
+            self.rows, self.row_masks, self.col_masks, self.quad_masks, self.quads, self.excluded)
+        full = self.full
+        out = []
+        for x, y in cells:
+            if rows[y][x] == 0:
+                used = row_masks[y] | col_masks[x] | quad_masks[quads[y][x]]
+                if excluded is not None:
+                    used |= excluded[y][x]
+                out.append((x, y, ~used & full))
+        return out
+
     def optimize(self) -> None:
         """Transform the board such that knowns are concentrated in the top left.
         Keep track of original shape of the board with self.rownums
 
         Sort the rows of quadrants in descending order weighted by the number of knowns/row.
         """
-        outrows = []
-        outrownums = []
+        outorder = []
         sorted_quad_rows = []
-        for qrownum, quad_rows in enumerate(sublists(self.rows, self.root)):
+        for qrownum in range(self.root):
             offset = qrownum * self.root
-            zipped = list(zip(quad_rows, self.rownums[
-                          offset:offset + self.root]))
-            zipped.sort(key=lambda x: weight_row(x[0]), reverse=True)
-            sorted_quad_rows.append(
-                (zipped, max(weight_row(i[0]) for i in zipped)))
+            zipped = [(weight_row(self.rows[i]), i)
+                      for i in range(offset, offset + self.root)]
+            zipped.sort(key=lambda x: x[0], reverse=True)
+            sorted_quad_rows.append((zipped, zipped[0][0]))
         sorted_quad_rows.sort(key=lambda x: x[1], reverse=True)
         for qrow in sorted_quad_rows:
-            for row in qrow[0]:
-                outrows.append(row[0])
-                outrownums.append(row[1])
-        self.rows = outrows
-        self.rownums = outrownums
+            outorder.extend(i for _, i in qrow[0])
+        self.permute_rows(outorder)
 
     def optimized(self):
         """Return optimized copy of self."""
@@ -184,10 +547,24 @@ class SudokuBoard():
 
     def unoptimize(self) -> None:
         """Sort self.rows by self.rownums."""
-        zipped = list(zip(self.rows, self.rownums))
-        zipped.sort(key=lambda x: x[1])
-        self.rows = [i[0] for i in zipped]
-        self.rownums = [i[1] for i in zipped]
+        order = sorted(range(self.size), key=lambda i: self.rownums[i])
+        self.permute_rows(order)
+
+    def permute_rows(self, order) -> None:
+        """Reorder the rows so that the row at position i becomes order[i].
+        Rows may only move within their row of quadrants and whole rows of
+        quadrants may only move together, which keeps the board's constraints
+        intact so the unit bitmasks can be permuted rather than recomputed."""
+        self.rows = [self.rows[i] for i in order]
+        self.rownums = [self.rownums[i] for i in order]
+        self.row_masks = [self.row_masks[i] for i in order]
+        if self.excluded is not None:
+            self.excluded = [self.excluded[i] for i in order]
+        quad_masks = self.quad_masks
+        self.quad_masks = []
+        for band in range(self.root):
+            src = (order[band * self.root] // self.root) * self.root
+            self.quad_masks.extend(quad_masks[src:src + self.root])
 
     def unoptimized(self):
         """Return untransformed copy of self."""
@@ -206,6 +583,46 @@ class SudokuBoard():
     def serialize(self):
         return '.'.join('.'.join([str(col) for col in row]) for row in self.rows)
 
+    def to_bytes(self) -> bytes:
+        """Encode the board compactly for sending between processes.
+        The layout is a header (size and bytes per item) followed by rownums
+        and then the cells in their current order, one byte per item for
+        boards of up to 255 digits and two bytes per item beyond that.
+        Candidates eliminated by propagation are not included."""
+        itemsize = 1 if self.size < 256 else 2
+        body = array.array('B' if itemsize == 1 else 'H', self.rownums)
+        for r in self.rows:
+            body.extend(r)
+        return _WIRE_HEADER.pack(self.size, itemsize) + body.tobytes()
+
+    @classmethod
+    def from_bytes(cls, data):
+        """Decode a board encoded by to_bytes()."""
+        size, itemsize = _WIRE_HEADER.unpack_from(data)
+        body = array.array('B' if itemsize == 1 else 'H')
+        body.frombytes(data[_WIRE_HEADER.size:])
+        new = cls(body[size:].tolist(), size)
+        new.rownums = body[:size].tolist()
+        return new
+
+
+_WIRE_HEADER = struct.Struct(">HB")
+
+
+def encode_board(board) -> bytes:
+    """Wire encoder for Backtracker, see SudokuBoard.to_bytes()."""
+    return board.to_bytes()
+
+
+def decode_board(data):
+    """Wire decoder for Backtracker, see SudokuBoard.from_bytes().
+    The wire format leaves out eliminated candidates, so the board is
+    propagated again: its children are propagated by assign(), which
+    expects that."""
+    board = SudokuBoard.from_bytes(data)
+    board.populate()
+    return board
+
 
 def weight_row(r):
     """Higher rating is better.
@@ -226,6 +643,101 @@ def all_digits(size):
     return set(range(1, size + 1))
 
 
+def full_mask(size) -> int:
+    """Return the bitmask with a bit set for every digit of a board of a given size."""
+    return (1 << size) - 1
+
+
+def digits_to_mask(digits) -> int:
+    """Return the bitmask of the nonzero digits in an iterable."""
+    m = 0
+    for d in digits:
+        if d != 0:
+            m |= 1 << (d - 1)
+    return m
+
+
+def mask_to_digits(mask) -> list:
+    """Return the digits whose bits are set in mask, in ascending order."""
+    out = []
+    while mask:
+        low = mask & -mask
+        out.append(low.bit_length())
+        mask ^= low
+    return out
+
+
+PROPAGATION_TECHNIQUES = ("naked_singles", "hidden_singles",
+                          "naked_subsets", "intersections")
+
+
+@functools.lru_cache(maxsize=None)
+def board_units(size) -> tuple:
+    """Return (units, cell_units) for a board of a given size.
+    units lists the (x, y) cells of every row, then every column, then every
+    quadrant. cell_units[y][x] holds the indices of the three units of x,y."""
+    root = int(size**(1 / 2))
+    rows = [[(x, y) for x in range(size)] for y in range(size)]
+    cols = [[(x, y) for y in range(size)] for x in range(size)]
+    quads = [[(root * (q % root) + i % root, root * (q // root) + i // root)
+              for i in range(size)] for q in range(size)]
+    cell_units = [[(y, size + x, 2 * size + root * (y // root) + x // root)
+                   for x in range(size)] for y in range(size)]
+    return rows + cols + quads, cell_units
+
+
+@functools.lru_cache(maxsize=None)
+def board_quadrants(size) -> list:
+    """Return the quadrant number of every cell of a board of a given size,
+    indexed [y][x]."""
+    root = int(size**(1 / 2))
+    return [[root * (y // root) + x // root for x in range(size)] for y in range(size)]
+
+
+@functools.lru_cache(maxsize=None)
+def board_peers(size) -> list:
+    """Return the (x, y) cells sharing a unit with every cell of a board of
+    a given size, indexed [y][x]."""
+    units, cell_units = board_units(size)
+    peers = []
+    for y in range(size):
+        row = []
+        for x in range(size):
+            cells = dict.fromkeys(c for u in cell_units[y][x] for c in units[u])
+            del cells[x, y]
+            row.append(list(cells))
+        peers.append(row)
+    return peers
+
+
+@functools.lru_cache(maxsize=None)
+def board_intersections(size) -> list:
+    """Return the intersections of every unit of board_units(size) with the
+    units crossing it, for SudokuBoard._intersections().
+    Each unit has a list of partitions of its cells into segments (one
+    partition for a row or a column: its quadrants; two for a quadrant: its
+    rows and its columns), and each segment is a tuple of (cells, cells of
+    the crossing unit outside the segment)."""
+    root = int(size**(1 / 2))
+    units, _ = board_units(size)
+    out = []
+    for u, cells in enumerate(units):
+        if u < 2 * size:
+            # a line crosses root quadrants, root cells at a time
+            lines = [cells[k * root:(k + 1) * root] for k in range(root)]
+            groups = [[(seg, 2 * size + board_quadrants(size)[seg[0][1]][seg[0][0]])
+                       for seg in lines]]
+        else:
+            # quadrant cells go across each row of the quadrant in turn
+            rows = [cells[k * root:(k + 1) * root] for k in range(root)]
+            cols = [cells[k::root] for k in range(root)]
+            groups = [[(seg, seg[0][1]) for seg in rows],
+                      [(seg, size + seg[0][0]) for seg in cols]]
+        out.append([[(seg, [c for c in units[other] if c not in seg]) for seg, other in group]
+                    for group in groups])
+    return out
+
+
 def lin_to_xy(n, size) -> tuple:
     """Get xy coords of linear position starting at top left
     and going right and down."""
@@ -252,33 +764,267 @@ def invalid_set(x) -> bool:
     return uniques < nozeroes
 
 
-def sudoku_next_choices(board) -> list:
+def popcount(mask) -> int:
+    """Return the number of set bits in mask."""
+    return bin(mask).count("1")
+
+
+if hasattr(int, "bit_count"):
+    # the same, without building a string (Python 3.10 and later)
+    popcount = int.bit_count
+
+
+def select_first_empty(board) -> tuple:
+    """Cell selection strategy: the first empty cell in row order.
+    Relies on optimize() to move the knowns towards the top left."""
+    return board.next_empty()
+
+
+def select_min_candidates(board) -> tuple:
+    """Cell selection strategy: the empty cell with the fewest candidates
+    (minimum remaining values). Returns None if there are no empty cells."""
+    best = None
+    best_count = board.size + 1
+    units, _ = board_units(board.size)
+    for row in units[:board.size]:
+        for x, y, m in board._empties(row):
+            count = popcount(m)
+            if count < best_count:
+                best = (x, y)
+                best_count = count
+                if count <= 1:
+                    # can't do better than a forced move or a dead end
+                    return best
+    return best
+
+
+def subtree_estimate(board) -> float:
+    """Estimate the size of the search tree below a board: the log2 of the
+    product of the numbers of candidates of its empty cells. See
+    backtracking.split_frontier()."""
+    units, _ = board_units(board.size)
+    log2 = math.log2
+    return sum(log2(popcount(m) or 1) for row in units[:board.size]
+               for _, _, m in board._empties(row))
+
+
+# name: (cell selection strategy, whether to optimize() the children)
+BRANCHING_STRATEGIES = {
+    "mrv": (select_min_candidates, False),
+    "first": (select_first_empty, True),
+}
+
+
+def sudoku_next_choices(board, select_cell=select_min_candidates, optimize=False) -> list:
     """Return next legal permutaions of a board.
-    Used for backtracking."""
+    Used for backtracking.
+    select_cell picks the empty cell to branch on, see BRANCHING_STRATEGIES."""
     out = []
     try:
-        x, y = board.next_empty()
+        x, y = select_cell(board)
     except TypeError:
         # no spaces found
         return []
     # print(x,y)
-    for c in board.candidates(x, y):
+    for c in mask_to_digits(board.candidate_mask(x, y)):
         # print(c,x,y)
         b = board.clone()
-        b.set(c, x, y)
-        # print(b)
-        b.optimize()
-        b.populate(max_depth=0)
+        if optimize:
+            b.set(c, x, y)
+            b.optimize()
+            b.populate()
+        else:
+            b.assign(c, x, y)
         out.append(b)
         # print("Set",x,y,"to",c)
     return out
 
 
+def next_choices_for(branching="mrv"):
+    """Return a next_choice_func for backtracking using the named branching strategy."""
+    try:
+        select_cell, optimize = BRANCHING_STRATEGIES[branching]
+    except KeyError:
+        raise ValueError("Unknown branching strategy: {}".format(branching))
+    return functools.partial(sudoku_next_choices, select_cell=select_cell, optimize=optimize)
+
+
+class TrailSearch():
+
+    """Depth first search of the subtree below a board, done in place.
+    Rather than cloning a board for every candidate the way
+    sudoku_next_choices() does, a digit is set on the one board, propagated,
+    and taken back from the board's trail when the search backtracks. Boards
+    are only copied for solutions and for split() subtrees handed to other
+    workers. Explores the same tree as sudoku_next_choices() with the same
+    select_cell. Implements the search_factory protocol of backtracking.backtrack().
+
+    Takes ownership of board, which should already be propagated. If
+    track_best is set, a copy of the fullest board reached is kept for best().
+
+    check_time is the time spent assigning and propagating the digits of
+    children and checking the boards that gives, as that is what rules out
+    illegal children here. max_stack is the most candidates left untried
+    along the path at once, the boards a cloning search would have stacked."""
+
+    def __init__(self, board, select_cell=select_min_candidates, track_best=False):
+        self.board = board
+        self.select_cell = select_cell
+        self.track_best = track_best
+        self._best = None
+        board.start_trail()
+        # one [mark, x, y, untried candidates] per level of the current path
+        self.frames = []
+        # whether the board is a node that hasn't been looked at yet
+        self.pending = True
+        self.finished = False
+        self.nodes = 0
+        self.children = 0
+        self.pruned = 0
+        self.max_depth = 0
+        self.check_time = 0.0
+        self.max_stack = 0
+        # candidates left in the frames
+        self._waiting = 0
+
+    def run(self, max_nodes=None) -> list:
+        """Explore up to max_nodes more nodes (all of them if None),
+        returning early with the first solution found."""
+        b = self.board
+        solutions = []
+        while not self.finished and (max_nodes is None or max_nodes > 0):
+            if self.pending:
+                self.pending = False
+                self.nodes += 1
+                if max_nodes is not None:
+                    max_nodes -= 1
+                if len(self.frames) > self.max_depth:
+                    self.max_depth = len(self.frames)
+                t0 = time.perf_counter()
+                legal = b.check_partial()
+                self.check_time += time.perf_counter() - t0
+                if legal:
+                    if self.track_best and (self._best is None or
+                                            b.num_empty < self._best.num_empty):
+                        self._best = b.clone()
+                    if b.num_empty == 0:
+                        solutions.append(b.clone())
+                    else:
+                        x, y = self.select_cell(b)
+                        mask = b.candidate_mask(x, y)
+                        self.frames.append([b.mark(), x, y, mask])
+                        self._waiting += popcount(mask)
+                        if self._waiting > self.max_stack:
+                            self.max_stack = self._waiting
+            self._advance()
+            if solutions:
+                break
+        return solutions
+
+    def _advance(self) -> None:
+        """Move the board to the next child to look at, or finish."""
+        b = self.board
+        frames = self.frames
+        while frames:
+            frame = frames[-1]
+            b.undo(frame[0])
+            mask = frame[3]
+            if mask == 0:
+                frames.pop()
+                continue
+            bit = mask & -mask
+            frame[3] = mask & ~bit
+            self._waiting -= 1
+            t0 = time.perf_counter()
+            b.assign(bit.bit_length(), frame[1], frame[2])
+            legal = b.check_partial()
+            self.check_time += time.perf_counter() - t0
+            self.children += 1
+            if legal:
+                self.pending = True
+                return
+            self.pruned += 1
+        self.finished = True
+
+    def best(self):
+        """Return the board with the fewest empty cells reached so far, if
+        track_best is set, see backtracking.backtrack()."""
+        return self._best
+
+    def split(self):
+        """Give up the shallowest unexplored subtree, see backtracking.backtrack().
+        Returns (depth, board) or None."""
+        for depth, frame in enumerate(self.frames):
+            while frame[3]:
+                mask = frame[3]
+                bit = mask & -mask
+                frame[3] = mask & ~bit
+                self._waiting -= 1
+                child = self.board.clone_at(frame[0])
+                child.assign(bit.bit_length(), frame[1], frame[2])
+                self.children += 1
+                if child.check_partial():
+                    return depth + 1, child
+                self.pruned += 1
+        if self.pending and not self.finished:
+            # only the board itself is left
+            self.finished = True
+            return len(self.frames), self.board.clone()
+        return None
+
+
+def search_factory_for(branching="mrv", track_best=False):
+    """Return a search_factory for backtracking using the named branching
+    strategy, or None if the strategy rearranges boards and so can't search
+    in place. track_best is passed on to TrailSearch."""
+    try:
+        select_cell, optimize = BRANCHING_STRATEGIES[branching]
+    except KeyError:
+        raise ValueError("Unknown branching strategy: {}".format(branching))
+    if optimize:
+        return None
+    return functools.partial(TrailSearch, select_cell=select_cell, track_best=track_best)
+
+
+def count_nodes(board, branching="mrv", limit=None) -> tuple:
+    """Search serially for the first solution of board, counting the nodes
+    (boards popped off the stack) along the way.
+    Returns (solution or None, number of nodes).
+    Used to compare the size of the search trees of the branching strategies.
+    Searches in place (see TrailSearch) when the strategy allows it."""
+    next_choice_func = next_choices_for(branching)
+    factory = search_factory_for(branching)
+    board = board.clone()
+    board.populate()
+    if factory is not None:
+        search = factory(board)
+        while not search.finished and (limit is None or search.nodes < limit):
+            found = search.run(None if limit is None else limit - search.nodes)
+            if found:
+                return found[0].unoptimized(), search.nodes
+        return None, search.nodes
+    stack = [board] if board.check_partial() else []
+    nodes = 0
+    while stack and (limit is None or nodes < limit):
+        partial = stack.pop()
+        nodes += 1
+        if sudoku_final_test(partial):
+            return partial.unoptimized(), nodes
+        stack.extend(g for g in reversed(next_choice_func(partial))
+                     if sudoku_partial_test(g))
+    return None, nodes
+
+
 def sudoku_final_test(board):
     """Return whether a board is completed."""
     return board.check()
 
 
+def filled_cells(board) -> int:
+    """Score partial solutions by how many cells they have filled in."""
+    return board.size * board.size - board.num_empty
+
+
 def sudoku_partial_test(board):
     """Return whether a board is still legal."""
     return board.check_partial()
@@ -293,28 +1039,827 @@ def board_from_string(s, size=9):
     return SudokuBoard(l, size)
 
 
-def solve_sudoku(board, *, num_processes=4, timeout=None):
+ENGINES = ("backtracking", "dlx")
+
+
+def dlx_solutions(board, stats=None):
+    """Generate every solution of board using the Dancing Links engine.
+    If stats is a dict its "nodes" counts the search nodes so far, see dlx.solutions()."""
+    plain = board.unoptimized()
+    for cells in dlx.solutions([v for r in plain.rows for v in r], board.size, stats):
+        yield SudokuBoard(cells, board.size)
+
+
+def dlx_count_solutions(board, limit=None) -> int:
+    """Count the solutions of board using the Dancing Links engine,
+    stopping at limit if given."""
+    plain = board.unoptimized()
+    return dlx.count([v for r in plain.rows for v in r], board.size, limit)
+
+
+# why solve_sudoku_report() stopped, see SolveReport
+SOLVE_REASONS = ("solved", "no_solution", "deadline", "node_budget", "cancelled")
+
+# the SOLVE_REASONS of the backtracking.STOP_REASONS of a search
+_STOP_REASONS = {"solutions": "solved", "exhausted": "no_solution", "deadline": "deadline",
+                 "node_budget": "node_budget", "cancelled": "cancelled", None: "cancelled"}
+
+
+class SolveReport():
+
+    """The outcome of solve_sudoku_report().
+
+    solution: the solved board, or None.
+    reason: why solving stopped, one of SOLVE_REASONS.
+    nodes: the number of nodes the backtracking search explored.
+    elapsed: seconds taken.
+    best: the solution, or failing that the board with the most cells filled
+        in that the search reached if it had a timeout or max_nodes, or None.
+    stats: the combined search counters, see backtracking.SearchStats."""
+
+    __slots__ = ("solution", "reason", "nodes", "elapsed", "best", "stats")
+
+    def __init__(self, solution=None, reason="no_solution", nodes=0, best=None, stats=None):
+        self.solution = solution
+        self.reason = reason
+        self.nodes = nodes
+        self.elapsed = 0.0
+        self.best = solution if solution is not None else best
+        self.stats = stats if stats is not None else {}
+
+    @property
+    def solved(self) -> bool:
+        return self.solution is not None
+
+    def __repr__(self) -> str:
+        filled = None if self.best is None else filled_cells(self.best)
+        return "SolveReport(reason={!r}, nodes={}, elapsed={:.3f}, filled={})".format(
+            self.reason, self.nodes, self.elapsed, filled)
+
+
+def _search_report(searcher, solution, stats) -> SolveReport:
+    """Return the SolveReport of the stopped search of a Backtracker or
+    BacktrackerPool, updating the stats dict if given."""
+    combined = searcher.stats()
+    if stats is not None:
+        stats.update(combined.as_dict())
+    best = None if combined.best is None else searcher.decode(combined.best).unoptimized()
+    reason = "solved" if solution is not None else _STOP_REASONS[searcher.reason()]
+    return SolveReport(solution, reason, combined.nodes, best, combined.as_dict())
+
+
+class SolverPool():
+
+    """Backtracking worker processes kept alive to solve one puzzle after another.
+    Spawning the workers often costs more than solving a puzzle, so use a
+    SolverPool instead of solve_sudoku() when solving many of them:
+
+        with SolverPool(processes=4) as pool:
+            for board in boards:
+                print(pool.solve(board))
+
+    Each solve runs in isolation from the previous one. Solves from several
+    threads are run one at a time."""
+
+    def __init__(self, processes=4):
+        self.processes = processes
+        self.pool = backtracking.BacktrackerPool(
+            processes, encode=encode_board, decode=decode_board)
+        self._lock = threading.Lock()
+        self._interrupt = None
+
+    def solve(self, board, **kwargs):
+        """Solve board with the pool's workers. Takes the same keyword
+        arguments as solve_sudoku(), except num_processes."""
+        return solve_sudoku(board, pool=self, **kwargs)
+
+    def search(self, board, branching="mrv", timeout=None, stats=None, interrupt=None,
+               max_nodes=None):
+        """Backtrack from board, which should already be propagated, and return
+        the first solution found or None. See solve_sudoku() for the other
+        arguments."""
+        return self.search_report(board, branching, timeout, stats, interrupt,
+                                  max_nodes).solution
+
+    def search_report(self, board, branching="mrv", timeout=None, stats=None, interrupt=None,
+                      max_nodes=None) -> SolveReport:
+        """search(), returning a SolveReport."""
+        ti = time.perf_counter()
+        limited = timeout is not None or max_nodes is not None
+        with self._lock:
+            self._interrupt = interrupt
+            self.pool.submit(
+                next_choice_func=next_choices_for(branching),
+                candidate_matcher=sudoku_final_test,
+                partial_checker=sudoku_partial_test,
+                starting_guesses=[board],
+                search_factory=search_factory_for(branching, track_best=limited),
+                max_nodes=max_nodes,
+                timeout=timeout,
+                partial_score=filled_cells if limited else None,
+                estimate=subtree_estimate)
+            solution = None
+            try:
+                if interrupt is not None and interrupt.is_set():
+                    self.pool.exchange.halt("cancelled")
+                elif not self.pool.wait(timeout):
+                    # the workers overran the deadline
+                    self.pool.exchange.halt("deadline")
+                elif self.pool.has_solution():
+                    solution = self.pool.get_solution().unoptimized()
+            finally:
+                self._interrupt = None
+                self.pool.cancel()
+            report = _search_report(self.pool, solution, stats)
+        report.elapsed = time.perf_counter() - ti
+        return report
+
+    def interrupt(self, interrupt) -> None:
+        """Stop the search started with the given interrupt event, if it is
+        still running. Set the event first: a search that hasn't been
+        submitted yet then stops as soon as it is. Safe to call from any thread."""
+        if self._interrupt is interrupt:
+            self.pool.exchange.halt("cancelled")
+
+    def iter_search(self, board, branching="mrv", limit=None):
+        """Backtrack from board, which should already be propagated, and
+        generate the solutions as they are found. The workers stop once
+        limit solutions have been found, or when the generator is closed."""
+        with self._lock:
+            self.pool.submit(
+                next_choice_func=next_choices_for(branching),
+                candidate_matcher=sudoku_final_test,
+                partial_checker=sudoku_partial_test,
+                starting_guesses=[board],
+                max_solutions=limit,
+                search_factory=search_factory_for(branching))
+            try:
+                yield from self.pool.iter_solutions()
+            finally:
+                self.pool.cancel()
+
+    def close(self):
+        """Shut the workers down."""
+        self.pool.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+
+# searches of solve_sudoku() and iter_solutions() stay in the calling process
+# until they pass this many nodes or seconds, see backtracking.Backtracker
+SERIAL_NODES = 1000
+SERIAL_TIME = 0.05
+
+
+def solve_sudoku(board, *, num_processes=None, timeout=None, branching="mrv", engine="backtracking", pool=None, stats=None, cache=None, interrupt=None, serial_nodes=SERIAL_NODES, serial_time=SERIAL_TIME, max_nodes=None):
+    """Return a solution of board, or None if there is none.
+    engine is one of ENGINES: "backtracking" searches with num_processes
+    worker processes, or with the workers of pool (a SolverPool) if given,
+    "dlx" runs Dancing Links in this process. By default (num_processes
+    None) choose_processes() picks how many workers the search needs, if
+    any, once the search has run serial_nodes or serial_time in this process.
+    If stats is a dict it is updated with the combined search counters of the
+    backtracking workers (see backtracking.SearchStats), which stay empty if
+    no search was needed. The dlx engine only sets "nodes".
+    If cache (a SolutionCache) is given, board and every board related to it
+    by a symmetry of Sudoku are only solved once.
+    interrupt is a threading.Event for searches on a pool: setting it and
+    calling pool.interrupt(interrupt) from another thread makes this return
+    None at once.
+    Without a pool, the search only moves to worker processes once it has
+    taken serial_nodes nodes or serial_time seconds in this one (pass None
+    for both to start the workers straight away).
+    The backtracking search gives up (returning None) timeout seconds after
+    it starts, or once it has explored max_nodes nodes. Its worker processes
+    are stopped, or killed if they don't stop, before this returns.
+    The dlx engine ignores both limits. Use solve_sudoku_report() to tell
+    running out of time from there being no solution."""
+    return solve_sudoku_report(
+        board, num_processes=num_processes, timeout=timeout, branching=branching,
+        engine=engine, pool=pool, stats=stats, cache=cache, interrupt=interrupt,
+        serial_nodes=serial_nodes, serial_time=serial_time, max_nodes=max_nodes).solution
+
+
+def solve_sudoku_report(board, **kwargs) -> SolveReport:
+    """Solve board as solve_sudoku() does, taking the same arguments, and
+    return a SolveReport of why solving stopped, how many nodes it took and,
+    if it gave up, the furthest it got."""
+    ti = time.perf_counter()
+    report = _solve_report(board, **kwargs)
+    report.elapsed = time.perf_counter() - ti
+    return report
+
+
+def _solve_report(board, *, num_processes=None, timeout=None, branching="mrv", engine="backtracking", pool=None, stats=None, cache=None, interrupt=None, serial_nodes=SERIAL_NODES, serial_time=SERIAL_TIME, max_nodes=None):
+    if engine not in ENGINES:
+        raise ValueError("Unknown engine: {}".format(engine))
     if not board.check_partial():
         raise ValueError("Ilegal starting board.")
+    if cache is None:
+        return _solve(board, num_processes, timeout, branching, engine, pool, stats, interrupt,
+                      serial_nodes, serial_time, max_nodes)
+    cells = [v for r in board.unoptimized().rows for v in r]
+    solution = cache.get(cells, board.size)
+    if solution is not None:
+        return SolveReport(SudokuBoard(solution, board.size), "solved")
+    report = _solve(board, num_processes, timeout, branching, engine, pool, stats, interrupt,
+                    serial_nodes, serial_time, max_nodes)
+    if report.solved:
+        cache.put(cells, board.size, [v for r in report.solution.rows for v in r])
+    return report
+
+
+def _solve(board, num_processes, timeout, branching, engine, pool, stats, interrupt,
+           serial_nodes, serial_time, max_nodes) -> SolveReport:
+    """Solve a legal board, see solve_sudoku()."""
+    if engine == "dlx":
+        counters = {"nodes": 0}
+        solution = next(dlx_solutions(board, counters), None)
+        if stats is not None:
+            stats.update(counters)
+        return SolveReport(solution, "no_solution" if solution is None else "solved",
+                           counters["nodes"])
+    board = board.clone()
+    board.populate()
+    if not board.check_partial():
+        # propagation proved there is no solution
+        return SolveReport(None, "no_solution")
+    if board.check():
+        return SolveReport(board.unoptimized(), "solved")
+    if pool is not None:
+        return pool.search_report(board, branching, timeout, stats, interrupt, max_nodes)
+    limited = timeout is not None or max_nodes is not None
     br = backtracking.Backtracker(
-        next_choice_func=sudoku_next_choices,
+        next_choice_func=next_choices_for(branching),
         candidate_matcher=sudoku_final_test,
         partial_checker=sudoku_partial_test,
-        starting_guesses=[board],)
+        starting_guesses=[board],
+        encode=encode_board,
+        decode=decode_board,
+        max_solutions=1,
+        serial_nodes=serial_nodes,
+        serial_time=serial_time,
+        search_factory=search_factory_for(branching, track_best=limited),
+        max_nodes=max_nodes,
+        timeout=timeout,
+        partial_score=filled_cells if limited else None,
+        estimate=subtree_estimate,
+        choose_workers=(functools.partial(choose_processes, branching=branching)
+                        if num_processes is None else None))
+    return _finish_search(br, num_processes, timeout, stats)
+
+
+# solve_sudoku() only hands a search to worker processes if it estimates
+# that more than this many seconds of searching are left, see choose_processes()
+PARALLEL_SECONDS = 0.25
+
+
+def choose_processes(partials, stats, branching="mrv", probes=8) -> int:
+    """Return how many worker processes finishing a search needs, for the
+    choose_workers of a backtracking.Backtracker: 0 (search on in this
+    process) if the partials left would take under PARALLEL_SECONDS to
+    search at the speed of the serial search that produced them (stats, a
+    backtracking.SearchStats), otherwise one per PARALLEL_SECONDS of it, up
+    to one per CPU. The size of what is left is estimated with probes
+    probes of backtracking.estimate_tree_size()."""
+    cpus = os.cpu_count() or 1
+    if cpus == 1:
+        return 0
+    if not stats.nodes or stats.elapsed <= 0:
+        # nothing to go on
+        return cpus
+    nodes = backtracking.estimate_tree_size(partials, next_choices_for(branching),
+                                            sudoku_partial_test, probes=probes, seed=0)
+    seconds = nodes * stats.elapsed / stats.nodes
+    n = min(cpus, math.ceil(seconds / PARALLEL_SECONDS))
+    return n if n > 1 else 0
+
+
+def _finish_search(br, num_processes, timeout, stats) -> SolveReport:
+    """Run the search of a Backtracker (or DistributedBacktracker) for the
+    first solution, stopping it once it is over, and return its SolveReport."""
+    deadline = None if timeout is None else time.time() + timeout
+    solution = None
+    try:
+        br.go(numthreads=num_processes)
+        if not br.wait(None if deadline is None else max(0, deadline - time.time())):
+            # the workers overran the deadline
+            br.exchange.halt("deadline")
+        elif br.has_solution():
+            solution = br.get_solution().unoptimized()
+    finally:
+        br.terminate()
+    return _search_report(br, solution, stats)
+
+
+def solve_distributed(board, address=("127.0.0.1", 0), authkey=None, *, num_processes=0,
+                      branching="mrv", timeout=None, max_nodes=None, stats=None,
+                      listening=None, **kwargs) -> SolveReport:
+    """Solve board with worker processes on any number of hosts and return
+    a SolveReport, see solve_sudoku_report().
+
+    The search is served at address with authkey (see
+    backtracking.DistributedBacktracker, which also takes the other keyword
+    arguments) to workers started with backtracking.remote_worker() or
+    `python -m sudoku_solving --connect HOST:PORT`, and num_processes local
+    ones. listening, if given, is called with the address actually served
+    once workers can connect."""
+    ti = time.perf_counter()
+    if not board.check_partial():
+        raise ValueError("Ilegal starting board.")
+    board = board.clone()
+    board.populate()
+    if not board.check_partial():
+        report = SolveReport(None, "no_solution")
+    elif board.check():
+        report = SolveReport(board.unoptimized(), "solved")
+    else:
+        limited = timeout is not None or max_nodes is not None
+        br = backtracking.DistributedBacktracker(
+            address, authkey,
+            next_choice_func=next_choices_for(branching),
+            candidate_matcher=sudoku_final_test,
+            partial_checker=sudoku_partial_test,
+            starting_guesses=[board],
+            encode=encode_board,
+            decode=decode_board,
+            max_solutions=1,
+            search_factory=search_factory_for(branching, track_best=limited),
+            max_nodes=max_nodes,
+            timeout=timeout,
+            partial_score=filled_cells if limited else None,
+            **kwargs)
+        if listening is not None:
+            listening(br.address)
+        report = _finish_search(br, num_processes, timeout, stats)
+    report.elapsed = time.perf_counter() - ti
+    return report
+
+
+class AsyncSolver():
+
+    """Solve boards from asyncio code without blocking the event loop.
+
+    Requests are queued and run on concurrency SolverPools of processes
+    worker processes each, so at most concurrency searches run at once and
+    no request starts processes of its own. If max_pending is given, at most
+    that many requests (running or queued) are accepted per event loop and
+    further callers wait their turn in solve().
+
+        async with AsyncSolver(concurrency=2, processes=4) as solver:
+            solutions = await asyncio.gather(*(solver.solve(b) for b in boards))
+
+    Cancelling a task awaiting solve() stops its search at once, freeing the
+    workers for the next request."""
+
+    def __init__(self, concurrency=1, processes=4, max_pending=None):
+        self.concurrency = concurrency
+        self.processes = processes
+        self.max_pending = max_pending
+        self.pools = [SolverPool(processes) for _ in range(concurrency)]
+        self._idle = queue.Queue()
+        for p in self.pools:
+            self._idle.put(p)
+        self._executor = concurrent.futures.ThreadPoolExecutor(concurrency)
+        # asyncio semaphores belong to a single event loop
+        self._limits = weakref.WeakKeyDictionary()
+
+    def _limit(self):
+        loop = asyncio.get_running_loop()
+        if loop not in self._limits:
+            self._limits[loop] = asyncio.Semaphore(self.max_pending)
+        return self._limits[loop]
+
+    def _run(self, board, interrupt, kwargs):
+        if interrupt.is_set():
+            return None
+        pool = self._idle.get()
+        try:
+            return pool.solve(board, interrupt=interrupt, **kwargs)
+        finally:
+            self._idle.put(pool)
+
+    async def solve(self, board, *, timeout=None, **kwargs):
+        """Return a solution of board, or None if there is none or timeout
+        seconds (counting the time spent queued) passed first.
+        Takes the same keyword arguments as solve_sudoku(), except
+        num_processes and pool."""
+        if self.max_pending is None:
+            return await self._solve(board, timeout, kwargs)
+        async with self._limit():
+            return await self._solve(board, timeout, kwargs)
+
+    async def _solve(self, board, timeout, kwargs):
+        interrupt = threading.Event()
+        future = asyncio.get_running_loop().run_in_executor(
+            self._executor, self._run, board, interrupt, kwargs)
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            if not future.done() or future.cancelled():
+                # timed out or cancelled while queued or searching
+                interrupt.set()
+                for p in self.pools:
+                    p.interrupt(interrupt)
+
+    def close(self):
+        """Shut the worker threads and processes down."""
+        self._executor.shutdown(wait=True)
+        for p in self.pools:
+            p.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await asyncio.get_running_loop().run_in_executor(None, self.close)
+        return False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+
+_shared_solver = None
+_shared_solver_lock = threading.Lock()
+
+
+def shared_solver() -> AsyncSolver:
+    """Return the AsyncSolver used by solve_sudoku_async(), starting it on
+    first use with one worker process per CPU. It is closed at exit."""
+    global _shared_solver
+    with _shared_solver_lock:
+        if _shared_solver is None:
+            _shared_solver = AsyncSolver(processes=os.cpu_count() or 1)
+            atexit.register(_shared_solver.close)
+        return _shared_solver
+
+
+async def solve_sudoku_async(board, *, timeout=None, solver=None, **kwargs):
+    """Return a solution of board, or None, without blocking the event loop.
+    Requests are queued on solver (an AsyncSolver), by default the one
+    returned by shared_solver(). See AsyncSolver.solve()."""
+    if solver is None:
+        solver = shared_solver()
+    return await solver.solve(board, timeout=timeout, **kwargs)
+
+
+def iter_solutions(board, *, num_processes=4, branching="mrv", engine="backtracking", pool=None, limit=None):
+    """Generate the solutions of board, each exactly once, as they are found.
+    With the backtracking engine the search runs on num_processes new
+    worker processes, or on pool (a SolverPool) if given. If limit is given
+    the whole search stops as soon as that many solutions have been found."""
+    if engine not in ENGINES:
+        raise ValueError("Unknown engine: {}".format(engine))
+    if not board.check_partial():
+        raise ValueError("Ilegal starting board.")
+    if engine == "dlx":
+        yield from itertools.islice(dlx_solutions(board), limit)
+        return
+    board = board.clone()
+    board.populate()
+    if not board.check_partial() or limit == 0:
+        return
+    if board.check():
+        # everything propagation deduces holds for every solution
+        yield board.unoptimized()
+        return
+    if pool is not None:
+        found = pool.iter_search(board, branching, limit)
+    else:
+        found = _backtracker_solutions(board, num_processes, branching, limit)
+    seen = set()
+    for solution in found:
+        solution.unoptimize()
+        key = solution.to_bytes()
+        if key in seen:
+            continue
+        seen.add(key)
+        yield solution
+        if limit is not None and len(seen) >= limit:
+            found.close()
+            return
+
+
+def _backtracker_solutions(board, num_processes, branching, limit):
+    """Generate the solutions found by a Backtracker started from board."""
+    br = backtracking.Backtracker(
+        next_choice_func=next_choices_for(branching),
+        candidate_matcher=sudoku_final_test,
+        partial_checker=sudoku_partial_test,
+        starting_guesses=[board],
+        encode=encode_board,
+        decode=decode_board,
+        max_solutions=limit,
+        serial_nodes=SERIAL_NODES,
+        serial_time=SERIAL_TIME,
+        search_factory=search_factory_for(branching))
     br.go(numthreads=num_processes)
-    ti = time.time()
-    while br.solutions_queue.empty():
-        if timeout:
-            if time.time() - ti >= timeout:
-                return None
-    br.terminate()
-    br.join()
-    if not br.solutions_queue.empty():
-        return br.solutions_queue.get().unoptimized()
+    try:
+        yield from br.iter_solutions()
+    finally:
+        br.terminate()
+
+
+def count_solutions(board, limit=None, **kwargs) -> int:
+    """Count the solutions of board, stopping the search at limit if given.
+    count_solutions(board, limit=2) == 1 checks that a puzzle is unique.
+    Takes the same keyword arguments as iter_solutions()."""
+    return sum(1 for _ in iter_solutions(board, limit=limit, **kwargs))
+
+
+# engines of solve_many(): "vectorized" propagates batches of puzzles in
+# NumPy and searches what is left like "backtracking"
+BATCH_ENGINES = ENGINES + ("vectorized",)
+
+
+def _puzzle_board(puzzle, size) -> SudokuBoard:
+    """Return a puzzle of solve_many() as a SudokuBoard."""
+    if isinstance(puzzle, str):
+        return board_from_string(puzzle, size)
+    elif isinstance(puzzle, SudokuBoard):
+        return puzzle
+    return SudokuBoard(list(puzzle), size)
+
+
+def _presolved(puzzles, size, batch_size):
+    """Propagate puzzles batch_size at a time with vectorized.propagate_batch().
+    Yields (index, puzzle, result): result is (index, solution cells or None)
+    for puzzles propagation settled, and None for those still to be searched,
+    whose puzzle is then replaced by the cells propagation filled in."""
+    jobs = enumerate(puzzles)
+    while True:
+        batch = list(itertools.islice(jobs, batch_size))
+        if not batch:
+            return
+        for index, puzzle in batch:
+            if puzzle is None:
+                yield index, None, (index, None)
+        batch = [(index, puzzle) for index, puzzle in batch if puzzle is not None]
+        if not batch:
+            continue
+        cells = []
+        for _, puzzle in batch:
+            board = _puzzle_board(puzzle, size).unoptimized()
+            cells.append([v for r in board.rows for v in r])
+        filled, status = vectorized.propagate_batch(cells, size)
+        for (index, _), f, st in zip(batch, filled.tolist(), status):
+            if st == vectorized.SOLVED:
+                yield index, None, (index, f)
+            elif st == vectorized.CONTRADICTION:
+                yield index, None, (index, None)
+            else:
+                yield index, f, None
+
+
+def _solve_one(job):
+    """Solve a single puzzle of solve_many() inside a worker process.
+    Returns (index, solution cells or None)."""
+    index, puzzle, size, engine, branching = job
+    board = _puzzle_board(puzzle, size)
+    if not board.check_partial():
+        return index, None
+    if engine == "dlx":
+        solution = next(dlx_solutions(board), None)
+    else:
+        solution, _ = count_nodes(board, branching)
+    if solution is None:
+        return index, None
+    return index, [v for r in solution.rows for v in r]
+
+
+def solve_many(puzzles, processes=4, ordered=False, *, size=9, engine="backtracking",
+               branching="mrv", max_in_flight=None, stats=None, batch_size=1024):
+    """Solve an iterable of puzzles, distributing whole puzzles across processes.
+    Puzzles may be SudokuBoards, strings (as for board_from_string) or lists,
+    or None to stand in for an unreadable puzzle, which isn't solved.
+
+    Yields (index, SudokuBoard) as each puzzle is solved, or (index, None) for
+    illegal or unsolvable puzzles. Results arrive in completion order unless
+    ordered is set. At most max_in_flight puzzles (4 per process by default)
+    are read ahead of the results being consumed, so arbitrarily long inputs
+    can be streamed through.
+
+    engine is one of BATCH_ENGINES. With "vectorized" (which needs numpy)
+    puzzles are read batch_size at a time and propagated together in this
+    process, and only those propagation can't finish are sent to the workers.
+
+    If stats is a dict it is kept updated with the number of puzzles "solved",
+    the "elapsed" seconds and "puzzles_per_second"."""
+    if engine not in BATCH_ENGINES:
+        raise ValueError("Unknown engine: {}".format(engine))
+    if max_in_flight is None:
+        max_in_flight = 4 * processes
+    results = queue.Queue()
+    if engine == "vectorized":
+        if not vectorized.available():
+            raise ImportError("The vectorized engine needs numpy.")
+        jobs = _presolved(puzzles, size, batch_size)
+        engine = "backtracking"
     else:
+        jobs = ((index, puzzle, None if puzzle is not None else (index, None))
+                for index, puzzle in enumerate(puzzles))
+    exhausted = False
+    in_flight = 0
+    waiting = {}
+    next_index = 0
+    done = 0
+    ti = time.time()
+    with multiprocessing.Pool(processes) as pool:
+        while True:
+            while not exhausted and in_flight < max_in_flight:
+                try:
+                    index, puzzle, result = next(jobs)
+                except StopIteration:
+                    exhausted = True
+                    break
+                in_flight += 1
+                if result is not None:
+                    results.put(result)
+                    continue
+                pool.apply_async(_solve_one, ((index, puzzle, size, engine, branching),),
+                                 callback=results.put, error_callback=results.put)
+            if in_flight == 0:
+                break
+            result = results.get()
+            if isinstance(result, BaseException):
+                raise result
+            index, cells = result
+            done += 1
+            if stats is not None:
+                elapsed = time.time() - ti
+                stats.update(solved=done, elapsed=elapsed,
+                             puzzles_per_second=done / elapsed if elapsed else 0.0)
+            solution = None if cells is None else SudokuBoard(cells, size)
+            if not ordered:
+                in_flight -= 1
+                yield index, solution
+                continue
+            # hold results back until all of the earlier ones are in
+            waiting[index] = solution
+            while next_index in waiting:
+                in_flight -= 1
+                yield next_index, waiting.pop(next_index)
+                next_index += 1
+
+
+# the levels of rate_puzzle(), from easiest to hardest
+DIFFICULTY_LEVELS = ("easy", "medium", "hard", "expert", "search")
+
+# the propagation techniques that solve puzzles of each level but "search",
+# each level adding one technique to the last
+LEVEL_TECHNIQUES = {level: PROPAGATION_TECHNIQUES[:i + 1]
+                    for i, level in enumerate(DIFFICULTY_LEVELS[:-1])}
+
+
+class Rating():
+
+    """The difficulty of a puzzle, see rate_puzzle().
+
+    level: one of DIFFICULTY_LEVELS.
+    techniques: the propagation techniques the puzzle needs, see LEVEL_TECHNIQUES.
+        "search" puzzles need all of them and backtracking as well.
+    nodes: the estimated size of the search tree left once propagation is
+        done, 0 for puzzles propagation solves.
+    score: a number to sort puzzles by: the index of the level in
+        DIFFICULTY_LEVELS, plus log10(nodes) for "search" puzzles."""
+
+    __slots__ = ("level", "techniques", "nodes", "score")
+
+    def __init__(self, level, techniques, nodes=0.0):
+        self.level = level
+        self.techniques = techniques
+        self.nodes = nodes
+        self.score = DIFFICULTY_LEVELS.index(level) + (math.log10(nodes) if nodes >= 1 else 0.0)
+
+    def as_dict(self) -> dict:
+        return {"level": self.level, "techniques": list(self.techniques),
+                "nodes": self.nodes, "score": self.score}
+
+    def __repr__(self) -> str:
+        return "Rating(level={!r}, nodes={:.0f}, score={:.2f})".format(
+            self.level, self.nodes, self.score)
+
+
+def rate_puzzle(board, branching="mrv", probes=16, seed=0) -> Rating:
+    """Rate how hard board is to solve: by the fewest propagation techniques
+    (see LEVEL_TECHNIQUES) that solve it on their own, or, for puzzles that
+    need backtracking, by the size of the search tree left after propagating
+    with all of them (probes probes of backtracking.estimate_tree_size() with
+    the given branching strategy, repeatable for a given seed).
+    Raises ValueError for illegal boards and for boards propagation proves
+    have no solution."""
+    if not board.check_partial():
+        raise ValueError("Ilegal starting board.")
+    board = board.unoptimized()
+    for level in DIFFICULTY_LEVELS[:-1]:
+        # each level's techniques include the last's, so carry on from there
+        board.propagate(LEVEL_TECHNIQUES[level])
+        if not board.check_partial():
+            raise ValueError("Board has no solution.")
+        if board.check():
+            return Rating(level, LEVEL_TECHNIQUES[level])
+    nodes = backtracking.estimate_tree_size([board], next_choices_for(branching),
+                                            sudoku_partial_test, probes=probes, seed=seed)
+    return Rating("search", PROPAGATION_TECHNIQUES, nodes)
+
+
+def _rate_one(job):
+    """Rate a single puzzle of rate_stream() inside a worker process.
+    Returns the Rating, or None for illegal and unsolvable puzzles."""
+    cells, size, branching = job
+    if cells is None:
+        return None
+    try:
+        return rate_puzzle(SudokuBoard(cells, size), branching)
+    except ValueError:
         return None
 
 
+def rate_stream(lines, out, *, size=9, fmt="auto", processes=4, branching="mrv") -> dict:
+    """Rate the puzzles in an iterable of lines (see read_puzzles()) with
+    rate_puzzle() in processes worker processes, writing an "id,level,nodes"
+    line per puzzle to out, a file, in input order. Unreadable, illegal and
+    unsolvable puzzles give an empty level.
+    Input is read a few puzzles per process at a time, so inputs of any
+    length stream through. Returns the number of puzzles of each level,
+    and of "unrated" ones."""
+    counts = dict.fromkeys(DIFFICULTY_LEVELS + ("unrated",), 0)
+    puzzles = read_puzzles(lines, size, fmt)
+    with multiprocessing.Pool(processes) as pool:
+        while True:
+            batch = list(itertools.islice(puzzles, 16 * processes))
+            if not batch:
+                break
+            ratings = pool.map(_rate_one, [(cells, size, branching) for _, cells in batch])
+            for (puzzle_id, _), rating in zip(batch, ratings):
+                if rating is None:
+                    counts["unrated"] += 1
+                    out.write("{},,\n".format(puzzle_id))
+                else:
+                    counts[rating.level] += 1
+                    out.write("{},{},{:.0f}\n".format(puzzle_id, rating.level, rating.nodes))
+            out.flush()
+    return counts
+
+
+def difficulty_rank(cells, size=9) -> int:
+    """Return the index in DIFFICULTY_LEVELS of the level rate_puzzle() gives
+    a serialized board, without estimating the size of its search. This is
+    the rate function generate_puzzle() passes to the generator."""
+    return DIFFICULTY_LEVELS.index(rate_puzzle(SudokuBoard(cells, size), probes=0).level)
+
+
+def _difficulty_job(difficulty) -> tuple:
+    """Return the (difficulty, rate) arguments of the generator for one of
+    DIFFICULTY_LEVELS, or None."""
+    if difficulty is None:
+        return None, None
+    if difficulty not in DIFFICULTY_LEVELS:
+        raise ValueError("Unknown difficulty: {}".format(difficulty))
+    return DIFFICULTY_LEVELS.index(difficulty), difficulty_rank
+
+
+def generate_puzzle(size=9, clues=None, symmetric=False, seed=None, unique=True,
+                    difficulty=None) -> SudokuBoard:
+    """Return a puzzle with a unique solution.
+    Clues are removed from a random full grid, checking uniqueness after every
+    removal, until only clues remain or no more can be removed. If symmetric is
+    set the clues are symmetric under a half turn. Checking uniqueness gets
+    slow on big boards: with unique set to False clues are removed without
+    checking, leaving a puzzle that is solvable but may not be unique.
+    difficulty, one of DIFFICULTY_LEVELS, makes it a puzzle rate_puzzle()
+    puts at that level: clues that would make it harder stay, and grids
+    that don't end up at the level are replaced, raising ValueError if
+    generator.DIFFICULTY_ATTEMPTS of them don't."""
+    return SudokuBoard(generator.generate(size, clues, symmetric, seed, unique,
+                                          *_difficulty_job(difficulty)), size)
+
+
+def generate_puzzles(count, size=9, clues=None, symmetric=False, processes=4, seed=None,
+                     unique=True, difficulty=None):
+    """Generate count puzzles (see generate_puzzle()) in parallel, yielding
+    them as they are finished. With a seed, the set of puzzles produced is
+    reproducible, though not the order in which they arrive."""
+    target, rate = _difficulty_job(difficulty)
+    jobs = ((size, clues, symmetric, None if seed is None else seed * 1000003 + i, unique,
+             target, rate)
+            for i in range(count))
+    with multiprocessing.Pool(processes) as pool:
+        for cells in pool.imap_unordered(generator.generate_job, jobs):
+            yield SudokuBoard(cells, size)
+
+
 def solve_string(s, *args, size=9, **kwargs) -> SudokuBoard:
     """Take a string serialized board return the solved board.
     Results may vary based on threading and race conditions."""
@@ -333,6 +1878,174 @@ def solve_list(l, size=9, *args, **kwargs) -> SudokuBoard:
     return solve_sudoku(SudokuBoard(l, size), *args, **kwargs)
 
 
+PUZZLE_FORMATS = ("auto", "line", "csv")
+
+
+def parse_puzzle(text, size=9) -> list:
+    """Return the serialized board written in text: size * size characters
+    with '.' or '0' for empty cells (boards of up to 9x9 only), or numbers
+    separated by '.' with 0 or nothing for empty cells.
+    Raises ValueError if text isn't a board of the given size."""
+    text = text.strip()
+    square = size * size
+    if size <= 9 and len(text) == square:
+        cells = [0 if c == '.' else int(c) for c in text]
+    else:
+        cells = [int(v) if v else 0 for v in text.split('.')]
+    if len(cells) != square or not all(0 <= v <= size for v in cells):
+        raise ValueError("Not a {0}x{0} board: {1!r}".format(size, text[:100]))
+    return cells
+
+
+def sniff_format(lines) -> tuple:
+    """Return (format, lines): the format of PUZZLE_FORMATS an iterable of
+    lines is in, "csv" if the first puzzle line has a comma in it, and an
+    iterable of the same lines, which may have been read from to find out."""
+    lines = iter(lines)
+    head = []
+    for line in lines:
+        head.append(line)
+        if line.strip() and not line.lstrip().startswith("#"):
+            break
+    fmt = "csv" if head and "," in head[-1] else "line"
+    return fmt, itertools.chain(head, lines)
+
+
+def read_puzzles(lines, size=9, fmt="auto", errors=None):
+    """Generate (id, serialized board or None) for each puzzle in an iterable
+    of lines, such as an open file, reading no further ahead than needed.
+
+    fmt is one of PUZZLE_FORMATS: "line" has one puzzle per line (see
+    parse_puzzle()) and its ids count the puzzles from 1, "csv" has an id
+    and a puzzle in the first two columns of every row, and "auto" uses
+    sniff_format(). A first CSV row that
+    isn't a puzzle is skipped as the header. Blank lines and lines starting
+    with # are skipped too. Puzzles that can't be read come with None, and
+    a message is written to errors, a file, if given."""
+    if fmt not in PUZZLE_FORMATS:
+        raise ValueError("Unknown puzzle format: {}".format(fmt))
+    if fmt == "auto":
+        fmt, lines = sniff_format(lines)
+    number = 0
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        number += 1
+        if fmt == "csv":
+            row = next(csv.reader([line]))
+            puzzle_id = row[0]
+            text = row[1] if len(row) > 1 else ""
+        else:
+            puzzle_id = str(number)
+            text = line
+        try:
+            cells = parse_puzzle(text, size)
+        except ValueError as e:
+            if fmt == "csv" and number == 1:
+                # the header
+                number = 0
+                continue
+            if errors is not None:
+                print("puzzle {}: {}".format(puzzle_id, e), file=errors)
+            cells = None
+        yield puzzle_id, cells
+
+
+def format_solution(board) -> str:
+    """Return a solution written the way parse_puzzle() reads it: one
+    character per cell up to 9x9, and '.' separated numbers beyond."""
+    if board.size <= 9:
+        return ''.join(str(v) for r in board.rows for v in r)
+    return board.serialize()
+
+
+def solve_stream(lines, out, *, size=9, fmt="auto", processes=4, engine="backtracking",
+                 branching="mrv", ordered=True, progress=None, interval=1.0) -> dict:
+    """Solve the puzzles in an iterable of lines (see read_puzzles()) with
+    solve_many(), writing each solution to out, a file, as it is found.
+
+    Input is read lazily and at most a few puzzles per process are in flight,
+    so inputs of any length stream through in constant memory. With ordered
+    set the solutions come out in the order of the puzzles, otherwise in the
+    order they are found. CSV input gives "id,solution" lines. Line input
+    gives a solution per line, prefixed with "number," (see read_puzzles())
+    if not ordered. Unreadable and unsolvable puzzles give an empty solution.
+
+    If progress is a file, the number of puzzles done and the throughput so
+    far are written to it every interval seconds, then once more at the end.
+    Returns the final counts: "solved", "unsolved", "elapsed" seconds and
+    "puzzles_per_second"."""
+    if fmt == "auto":
+        fmt, lines = sniff_format(lines)
+    # the ids of the puzzles in flight, by index
+    ids = {}
+
+    def puzzles():
+        for i, (puzzle_id, cells) in enumerate(read_puzzles(lines, size, fmt, progress)):
+            ids[i] = puzzle_id
+            yield cells
+
+    counts = {"solved": 0, "unsolved": 0}
+    ti = time.time()
+    last = ti
+
+    def report(end="\r"):
+        elapsed = time.time() - ti
+        counts.update(elapsed=elapsed, puzzles_per_second=(
+            (counts["solved"] + counts["unsolved"]) / elapsed if elapsed else 0.0))
+        if progress is not None:
+            progress.write("{solved} solved, {unsolved} unsolved, {puzzles_per_second:.1f} "
+                           "puzzles/second{end}".format(end=end, **counts))
+            progress.flush()
+
+    results = solve_many(puzzles(), processes, ordered, size=size, engine=engine,
+                         branching=branching)
+    try:
+        for index, solution in results:
+            puzzle_id = ids.pop(index)
+            if solution is None:
+                counts["unsolved"] += 1
+                text = ""
+            else:
+                counts["solved"] += 1
+                text = format_solution(solution)
+            if fmt == "csv" or not ordered:
+                out.write("{},{}\n".format(puzzle_id, text))
+            else:
+                out.write(text + "\n")
+            now = time.time()
+            if now - last >= interval:
+                last = now
+                out.flush()
+                report()
+    finally:
+        # stops the workers straight away if writing fails, such as when
+        # the reader of a pipe goes away
+        results.close()
+    out.flush()
+    report("\n")
+    return counts
+
+
+def _input_lines(paths):
+    """Generate the lines of the files at paths in turn, "-" being stdin."""
+    for path in paths:
+        if path == "-":
+            yield from sys.stdin
+        else:
+            with open(path) as f:
+                yield from f
+
+
+def parse_address(text) -> tuple:
+    """Return the (host, port) of a "HOST:PORT" string."""
+    host, sep, port = text.rpartition(":")
+    if not sep or not port.isdigit():
+        raise ValueError("Not a HOST:PORT address: {!r}".format(text))
+    return host, int(port)
+
+
 def quit_handler(a, b):
     print("Caught Ctrl-C")
     raise UserRequestedQuit()
@@ -340,13 +2053,51 @@ def quit_handler(a, b):
 
 def main():
     parser = argparse.ArgumentParser(
-        description="Solve Sudoku puzzles with logic and multiprocessed backtracking.")
+        description="Solve Sudoku puzzles with logic and multiprocessed backtracking. "
+        "Given no BOARD, puzzles are streamed from --input files or from stdin when it is "
+        "not a terminal, and their solutions written out as they are found.")
     parser.add_argument("board", nargs="?", metavar="BOARD",
                         help="Serialized board, read from top left to right. Use '.' for empty cell.", type=str)
     parser.add_argument(
         "-s", metavar="Board size. Must be a square number.", type=int, default=9)
     parser.add_argument(
-        "-p", metavar="Number of processes.", type=int, default=4)
+        "-p", metavar="Number of processes.", type=int, default=None,
+        help="Number of processes, 4 by default, or for BOARD as many as the "
+        "estimated size of its search calls for.")
+    parser.add_argument("--branching", choices=sorted(BRANCHING_STRATEGIES), default="mrv",
+                        help="Strategy for picking the cell to branch on.")
+    parser.add_argument("--engine", choices=BATCH_ENGINES, default="backtracking",
+                        help="Solver engine to use. vectorized (which needs numpy) "
+                        "only applies to streams.")
+    parser.add_argument("-i", "--input", metavar="FILE", action="append",
+                        help="File of puzzles to stream, '-' for stdin. May be repeated.")
+    parser.add_argument("-o", "--output", metavar="FILE",
+                        help="Where to write the solutions of a stream, stdout by default.")
+    parser.add_argument("--format", choices=PUZZLE_FORMATS, default="auto",
+                        help="Format of the streamed puzzles: a puzzle per line, "
+                        "or CSV rows of id and puzzle.")
+    parser.add_argument("--unordered", action="store_true",
+                        help="Write the solutions of a stream as they are found rather "
+                        "than in input order, prefixed with the puzzle number.")
+    parser.add_argument("-q", "--quiet", action="store_true",
+                        help="Don't write the progress of a stream to stderr.")
+    parser.add_argument("--stats", action='store_true',
+                        help="Print the search counters as JSON on stderr.")
+    parser.add_argument("--timeout", metavar="SECONDS", type=float,
+                        help="Give up on a board after this many seconds.")
+    parser.add_argument("--max-nodes", metavar="NODES", type=int,
+                        help="Give up on a board after searching this many nodes.")
+    parser.add_argument("--listen", metavar="HOST:PORT",
+                        help="Serve the search for BOARD to workers on other hosts, "
+                        "as well as to -p local ones.")
+    parser.add_argument("--connect", metavar="HOST:PORT",
+                        help="Run -p workers for the search served at this address.")
+    parser.add_argument("--authkey",
+                        help="Shared secret of --listen and --connect, "
+                        "by default the SUDOKU_AUTHKEY environment variable.")
+    parser.add_argument("--rate", action="store_true",
+                        help="Rate the difficulty of BOARD (as JSON) or of the streamed "
+                        "puzzles (as id,level,nodes lines) instead of solving.")
     parser.add_argument("--flat", action='store_const', const=True)
     parser.add_argument("--debug", action='store_const', const=True)
     parser.add_argument("--show", help="Pretty print the board before solving.",
@@ -354,16 +2105,81 @@ def main():
     cmdargs = parser.parse_args()
     if cmdargs.debug:
         print("ARGS:", cmdargs)
+    authkey = cmdargs.authkey or os.environ.get("SUDOKU_AUTHKEY")
+    if (cmdargs.listen or cmdargs.connect) and not authkey:
+        parser.error("--listen and --connect need --authkey or SUDOKU_AUTHKEY")
+    processes = 4 if cmdargs.p is None else cmdargs.p
+    if cmdargs.connect:
+        address = parse_address(cmdargs.connect)
+        workers = [multiprocessing.Process(target=backtracking.remote_worker,
+                                           args=(address, authkey.encode()))
+                   for _ in range(processes)]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+        return
+    if cmdargs.rate and cmdargs.board:
+        rating = rate_puzzle(board_from_string(cmdargs.board, cmdargs.s), cmdargs.branching)
+        print(json.dumps(rating.as_dict(), sort_keys=True))
+        return
+    if cmdargs.input or (not cmdargs.board and not sys.stdin.isatty()):
+        out = sys.stdout if cmdargs.output is None else open(cmdargs.output, "w")
+        try:
+            if cmdargs.rate:
+                counts = rate_stream(_input_lines(cmdargs.input or ["-"]), out,
+                                     size=cmdargs.s, fmt=cmdargs.format,
+                                     processes=processes, branching=cmdargs.branching)
+            else:
+                counts = solve_stream(_input_lines(cmdargs.input or ["-"]), out,
+                                      size=cmdargs.s, fmt=cmdargs.format, processes=processes,
+                                      engine=cmdargs.engine, branching=cmdargs.branching,
+                                      ordered=not cmdargs.unordered,
+                                      progress=None if cmdargs.quiet else sys.stderr)
+        except BrokenPipeError:
+            # the reader went away (as with "| head"), so stop quietly like
+            # other filters do, without Python complaining that stdout can't
+            # be flushed at exit
+            os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+            sys.exit(1)
+        finally:
+            if out is not sys.stdout:
+                out.close()
+        if cmdargs.stats:
+            print(json.dumps(counts, sort_keys=True), file=sys.stderr)
+        return
+    if cmdargs.engine not in ENGINES:
+        parser.error("--engine {} only applies to streams".format(cmdargs.engine))
     if cmdargs.board:
         try:
             b = board_from_string(cmdargs.board, cmdargs.s)
             if cmdargs.show:
                 print(b)
-            solution = solve_sudoku(b, num_processes=cmdargs.p)
-            if cmdargs.flat:
-                print(solution.serialize())
+            stats = {}
+            if cmdargs.listen:
+                report = solve_distributed(
+                    b, parse_address(cmdargs.listen), authkey.encode(),
+                    num_processes=processes, branching=cmdargs.branching, stats=stats,
+                    timeout=cmdargs.timeout, max_nodes=cmdargs.max_nodes,
+                    listening=lambda a: print("Serving on {}:{}".format(*a), file=sys.stderr))
             else:
-                print(solution)
+                report = solve_sudoku_report(b, num_processes=cmdargs.p,
+                                             branching=cmdargs.branching,
+                                             engine=cmdargs.engine, stats=stats,
+                                             timeout=cmdargs.timeout,
+                                             max_nodes=cmdargs.max_nodes)
+            solution = report.solution
+            if cmdargs.stats:
+                print(json.dumps(stats, sort_keys=True), file=sys.stderr)
+            if solution is None:
+                print("No solution ({}) after {} nodes in {:.2f}s".format(
+                    report.reason, report.nodes, report.elapsed), file=sys.stderr)
+                if report.best is not None:
+                    print("Furthest reached ({} cells filled):".format(
+                        filled_cells(report.best)), file=sys.stderr)
+                    solution = report.best
+            if solution is not None:
+                print(solution.serialize() if cmdargs.flat else solution)
 
             quit()
         except Exception as e:
@@ -405,26 +2221,26 @@ def main():
     print(numthreads, "process(es)")
     ti_solve = time.time()
     br = backtracking.Backtracker(
-        next_choice_func=sudoku_next_choices,
+        next_choice_func=next_choices_for(cmdargs.branching),
         candidate_matcher=sudoku_final_test,
         partial_checker=sudoku_partial_test,
-        starting_guesses=[tb])
+        starting_guesses=[tb],
+        encode=encode_board,
+        decode=decode_board)
     br.go(numthreads=numthreads)
 
-    while br.solutions_queue.empty():
-        pass
-    br.terminate()
-    br.join()
-    if not br.solutions_queue.empty():
+    br.wait()
+    if br.has_solution():
+        results = [br.get_solution()]
         print("Solution found!")
         print("DeltaT = {:.5f}ish".format(time.time() - ti_solve), "seconds")
-        results = []
         while not br.solutions_queue.empty():
-            r = br.solutions_queue.get()
+            results.append(br.get_solution())
+        for r in results:
             r.unoptimize()
             print(r)
-            results.append(r)
         results = [i for i in results if i.check()]
+    br.terminate()
         # with open("solutions.txt", 'w') as f:
         #     f.write("{} boards\n".format(len(results)) +
         #             '\n'.join(str(i) for i in results))
@@ -435,6 +2251,9 @@ def main():
     # with open("discarded.txt", 'w') as f:
     #     f.write("{} discarded\n".format(len(discarded)) + '\n'.join(discarded))
 
+    if cmdargs.stats:
+        print(br.stats().to_json(), file=sys.stderr)
+
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,284 @@
+"""Canonical forms of boards under the symmetries of Sudoku, and a cache of
+solutions keyed by them.
+
+Relabelling the digits, permuting the rows within a band (or the columns
+within a stack), permuting the bands (or stacks) and transposing all turn a
+puzzle into an equivalent one, whose solution is the original solution
+transformed the same way. canonical_form() picks one representative of
+every such family, so equivalent puzzles can share a cache entry.
+Boards, and the solutions kept by SolutionCache, are serialized lists of digits."""
+import array
+import collections
+import itertools
+import os
+import sqlite3
+import threading
+
+# how many arrangements canonical_form() compares before settling for the
+# best one seen so far
+MAX_CANDIDATES = 1000
+
+
+def _grid(cells, size) -> list:
+    return [list(cells[i:i + size]) for i in range(0, size * size, size)]
+
+
+def _transposed(grid) -> list:
+    return [list(col) for col in zip(*grid)]
+
+
+def _line_keys(grid, size) -> tuple:
+    """Return keys of the rows and columns of grid that don't change under
+    any symmetry other than transposition: a line's number of clues and the
+    numbers of clues in the crossing lines its clues are on."""
+    row_counts = [sum(1 for v in r if v) for r in grid]
+    col_counts = [sum(1 for r in grid if r[c]) for c in range(size)]
+    rows = [(row_counts[y], sorted(col_counts[x] for x in range(size) if grid[y][x]))
+            for y in range(size)]
+    cols = [(col_counts[x], sorted(row_counts[y] for y in range(size) if grid[y][x]))
+            for x in range(size)]
+    return rows, cols
+
+
+def _tied_orders(items, key):
+    """Generate every ordering of items sorted by key, where items with equal
+    keys may come in any order."""
+    items = sorted(items, key=key)
+    groups = [list(g) for _, g in itertools.groupby(items, key)]
+
+    def orders(i):
+        if i == len(groups):
+            yield []
+            return
+        for head in itertools.permutations(groups[i]):
+            for rest in orders(i + 1):
+                yield list(head) + rest
+    return orders(0)
+
+
+def _line_orders(keys, root):
+    """Generate the orders of the lines with the given keys that put the
+    bands in order of their sorted keys, then the lines within each band in
+    order of their keys, with ties in every order."""
+    def band_key(b):
+        return sorted(keys[b * root:(b + 1) * root])
+
+    def orders(bands, k):
+        if k == root:
+            yield []
+            return
+        b = bands[k]
+        for lines in _tied_orders(range(b * root, (b + 1) * root), keys.__getitem__):
+            for rest in orders(bands, k + 1):
+                yield lines + rest
+    for bands in _tied_orders(range(root), band_key):
+        yield from orders(bands, 0)
+
+
+def _relabelled(grid, rows, cols, size) -> tuple:
+    """Return the cells of grid in the given row and column order with the
+    digits renumbered by first appearance, and the renumbering."""
+    labels = [0] * (size + 1)
+    label = 1
+    out = []
+    for y in rows:
+        row = grid[y]
+        for x in cols:
+            v = row[x]
+            if v and not labels[v]:
+                labels[v] = label
+                label += 1
+            out.append(labels[v])
+    # digits that aren't on the board take the remaining labels in order
+    for d in range(1, size + 1):
+        if not labels[d]:
+            labels[d] = label
+            label += 1
+    return out, labels
+
+
+def canonical_form(cells, size=9) -> tuple:
+    """Return (canonical cells, transform) of a serialized board.
+    Boards related by a symmetry of Sudoku get the same canonical cells, as
+    long as their symmetries leave at most MAX_CANDIDATES arrangements to
+    compare (past that, the result is still a fixed function of the board,
+    just not always shared with its relatives). The transform maps the board
+    to its canonical form, see apply_transform() and invert_transform()."""
+    root = int(size**(1 / 2))
+    best = None
+    candidates = []
+    for transpose in (False, True):
+        grid = _grid(cells, size)
+        if transpose:
+            grid = _transposed(grid)
+        row_keys, col_keys = _line_keys(grid, size)
+        signature = ([sorted(row_keys[b * root:(b + 1) * root]) for b in range(root)],
+                     [sorted(col_keys[b * root:(b + 1) * root]) for b in range(root)])
+        signature = (sorted(signature[0]), sorted(signature[1]))
+        candidates.append((signature, transpose, grid, row_keys, col_keys))
+    # only the orientation(s) with the smallest signature can be canonical
+    least = min(c[0] for c in candidates)
+    budget = MAX_CANDIDATES
+    for signature, transpose, grid, row_keys, col_keys in candidates:
+        if signature != least:
+            continue
+        col_orders = list(itertools.islice(_line_orders(col_keys, root), budget))
+        for rows in _line_orders(row_keys, root):
+            if budget <= 0:
+                return best
+            for cols in col_orders[:budget]:
+                budget -= 1
+                out, labels = _relabelled(grid, rows, cols, size)
+                if best is None or out < best[0]:
+                    best = (out, (transpose, rows, cols, labels))
+    return best
+
+
+def apply_transform(cells, transform, size=9) -> list:
+    """Transform a serialized board (such as a solution of the board the
+    transform came from) the same way canonical_form() did."""
+    transpose, rows, cols, labels = transform
+    grid = _grid(cells, size)
+    if transpose:
+        grid = _transposed(grid)
+    return [labels[grid[y][x]] for y in rows for x in cols]
+
+
+def invert_transform(cells, transform, size=9) -> list:
+    """Undo apply_transform()."""
+    transpose, rows, cols, labels = transform
+    digits = [0] * (size + 1)
+    for d in range(1, size + 1):
+        digits[labels[d]] = d
+    grid = [[0] * size for _ in range(size)]
+    for i, y in enumerate(rows):
+        for j, x in enumerate(cols):
+            grid[y][x] = digits[cells[i * size + j]]
+    if transpose:
+        grid = _transposed(grid)
+    return [v for r in grid for v in r]
+
+
+def _key(cells, size) -> bytes:
+    return array.array('B' if size < 256 else 'H', [size] + list(cells)).tobytes()
+
+
+def _cells(key, size) -> list:
+    body = array.array('B' if size < 256 else 'H')
+    body.frombytes(key)
+    return body[1:].tolist()
+
+
+class SolutionCache():
+
+    """Solutions of boards, found again for any board related to a cached one
+    by a symmetry of Sudoku.
+
+    The most recently used maxsize entries are kept in memory. If path is
+    given the solutions are also stored in a sqlite database there, which
+    outlives the process and may be shared by any number of processes.
+    Boards and solutions are serialized lists of digits."""
+
+    def __init__(self, maxsize=1024, path=None):
+        self.maxsize = maxsize
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        self._pid = None
+        self._last = None
+
+    def _connection(self):
+        # a connection can't be shared with forked children
+        if self._db is None or self._pid != os.getpid():
+            self._db = sqlite3.connect(self.path, timeout=30, isolation_level=None,
+                                       check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS solutions "
+                             "(puzzle BLOB PRIMARY KEY, solution BLOB NOT NULL)")
+            self._pid = os.getpid()
+        return self._db
+
+    def _remember(self, key, value) -> None:
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def _lookup(self, key):
+        value = self._entries.get(key)
+        if value is not None:
+            self._entries.move_to_end(key)
+            return value
+        if self.path is None:
+            return None
+        row = self._connection().execute(
+            "SELECT solution FROM solutions WHERE puzzle = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        self._remember(key, row[0])
+        return row[0]
+
+    def _canonical(self, cells, size) -> tuple:
+        """Return (canonical key, transform) of cells, remembering the last
+        board so that a get() miss followed by put() canonicalizes once."""
+        raw = _key(cells, size)
+        if self._last is None or self._last[0] != raw:
+            canonical, transform = canonical_form(cells, size)
+            self._last = (raw, _key(canonical, size), transform)
+        return self._last[1:]
+
+    def get(self, cells, size=9):
+        """Return the cached solution of a serialized board, or None."""
+        raw = _key(cells, size)
+        with self._lock:
+            # exact repeats are found without canonicalizing
+            value = self._entries.get(raw)
+            if value is not None:
+                self._entries.move_to_end(raw)
+                self.hits += 1
+                return _cells(value, size)
+            key, transform = self._canonical(cells, size)
+            value = self._lookup(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            solution = invert_transform(_cells(value, size), transform, size)
+            self._remember(raw, _key(solution, size))
+            return solution
+
+    def put(self, cells, size, solution) -> None:
+        """Cache the solution of a serialized board."""
+        with self._lock:
+            key, transform = self._canonical(cells, size)
+            value = _key(apply_transform(solution, transform, size), size)
+            self._remember(key, value)
+            self._remember(_key(cells, size), _key(solution, size))
+            if self.path is not None:
+                self._connection().execute(
+                    "INSERT OR REPLACE INTO solutions VALUES (?, ?)", (key, value))
+
+    def clear(self) -> None:
+        """Forget the solutions held in memory (but not those on disk)."""
+        with self._lock:
+            self._entries.clear()
+
+    def close(self) -> None:
+        if self._db is not None and self._pid == os.getpid():
+            self._db.close()
+        self._db = None
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.update(_db=None, _pid=None, _lock=None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
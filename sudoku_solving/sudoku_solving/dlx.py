@@ -0,0 +1,298 @@
+"""Exact cover solving with Knuth's Dancing Links (Algorithm X).
+Sudoku boards of any square size are modelled as exact cover problems.
+Like the rest of the library, boards are serialized lists of digits
+with 0 for an empty cell."""
+
+
+class DancingLinks():
+
+    """A sparse exact cover matrix stored as circular doubly linked lists.
+    The links live in flat lists indexed by node number: node 0 is the root,
+    nodes 1..num_columns are the column headers and the rest are the 1s of
+    the matrix. nodes counts the rows solutions() has tried so far."""
+
+    def __init__(self, num_columns):
+        n = num_columns + 1
+        self.num_columns = num_columns
+        self.left = [(i - 1) % n for i in range(n)]
+        self.right = [(i + 1) % n for i in range(n)]
+        self.up = list(range(n))
+        self.down = list(range(n))
+        self.column = list(range(n))
+        self.sizes = [0] * n
+        self.labels = [None] * n
+        self.nodes = 0
+
+    def add_row(self, columns, label) -> int:
+        """Add a row with 1s in the given columns (numbered from 0).
+        label is what the solutions report for this row.
+        Returns the number of the row's first node, for select()."""
+        first = None
+        for c in columns:
+            c += 1
+            node = len(self.column)
+            self.column.append(c)
+            self.labels.append(label)
+            # insert at the bottom of the column
+            self.up.append(self.up[c])
+            self.down.append(c)
+            self.down[self.up[c]] = node
+            self.up[c] = node
+            self.sizes[c] += 1
+            # insert at the end of the row
+            if first is None:
+                first = node
+                self.left.append(node)
+                self.right.append(node)
+            else:
+                self.left.append(self.left[first])
+                self.right.append(first)
+                self.right[self.left[first]] = node
+                self.left[first] = node
+        return first
+
+    def select(self, row) -> None:
+        """Force the row starting at node row into every solution by covering
+        all of its columns. Rows must be deselected in the reverse order."""
+        self._cover(self.column[row])
+        j = self.right[row]
+        while j != row:
+            self._cover(self.column[j])
+            j = self.right[j]
+
+    def deselect(self, row) -> None:
+        """Undo select(row)."""
+        j = self.left[row]
+        while j != row:
+            self._uncover(self.column[j])
+            j = self.left[j]
+        self._uncover(self.column[row])
+
+    def _cover(self, c):
+        left, right, up, down, column, sizes = (
+            self.left, self.right, self.up, self.down, self.column, self.sizes)
+        right[left[c]] = right[c]
+        left[right[c]] = left[c]
+        i = down[c]
+        while i != c:
+            j = right[i]
+            while j != i:
+                down[up[j]] = down[j]
+                up[down[j]] = up[j]
+                sizes[column[j]] -= 1
+                j = right[j]
+            i = down[i]
+
+    def _uncover(self, c):
+        left, right, up, down, column, sizes = (
+            self.left, self.right, self.up, self.down, self.column, self.sizes)
+        i = up[c]
+        while i != c:
+            j = left[i]
+            while j != i:
+                sizes[column[j]] += 1
+                down[up[j]] = j
+                up[down[j]] = j
+                j = left[j]
+            i = up[i]
+        right[left[c]] = c
+        left[right[c]] = c
+
+    def _choose_column(self) -> int:
+        """Return the column with the fewest 1s left (Knuth's S heuristic)."""
+        right, sizes = self.right, self.sizes
+        best = right[0]
+        c = right[best]
+        while c != 0 and sizes[best] > 1:
+            if sizes[c] < sizes[best]:
+                best = c
+            c = right[c]
+        return best
+
+    def solutions(self):
+        """Generate every exact cover as a list of row labels.
+        The search is iterative so very large problems can't overflow the stack.
+        The matrix is restored once the generator is exhausted or closed."""
+        right, left, down, column = self.right, self.left, self.down, self.column
+        chosen = []
+        try:
+            while True:
+                if right[0] == 0:
+                    yield [self.labels[r] for r in chosen]
+                    r = None
+                else:
+                    c = self._choose_column()
+                    self._cover(c)
+                    r = down[c]
+                    chosen.append(r)
+                # advance to the next row to try, backtracking as needed
+                while True:
+                    if r is None:
+                        if not chosen:
+                            return
+                        r = chosen[-1]
+                        j = left[r]
+                        while j != r:
+                            self._uncover(column[j])
+                            j = left[j]
+                        r = down[r]
+                        chosen[-1] = r
+                    c = column[r]
+                    if r == c:
+                        # every row of this column has been tried
+                        self._uncover(c)
+                        chosen.pop()
+                        r = None
+                        continue
+                    j = right[r]
+                    while j != r:
+                        self._cover(column[j])
+                        j = right[j]
+                    self.nodes += 1
+                    break
+        finally:
+            # leave the matrix as it was if the caller stopped early
+            while chosen:
+                r = chosen.pop()
+                c = column[r]
+                if r != c:
+                    j = left[r]
+                    while j != r:
+                        self._uncover(column[j])
+                        j = left[j]
+                self._uncover(c)
+
+
+def _units(i, size, root):
+    """Return the row, column and quadrant unit numbers of cell index i."""
+    y, x = divmod(i, size)
+    return (y, size + x, 2 * size + root * (y // root) + x // root)
+
+
+class SudokuExactCover():
+
+    """The full exact cover matrix of an empty board of a given size.
+    Building the matrix is the expensive part of Dancing Links, so this
+    keeps one around and handles givens by selecting their rows for the
+    duration of a search, leaving the matrix as it was afterwards. Useful
+    when solving many boards of the same size, such as the candidate
+    puzzles of a generator."""
+
+    def __init__(self, size=9):
+        self.size = size
+        self.root = int(size**(1 / 2))
+        square = size * size
+        self.matrix = DancingLinks(4 * square)
+        self.rows = {}
+        for i in range(square):
+            units = _units(i, size, self.root)
+            for d in range(size):
+                self.rows[i, d + 1] = self.matrix.add_row(
+                    [i] + [square + u * size + d for u in units], (i, d + 1))
+
+    def solutions(self, cells):
+        """Generate every solution of a serialized board."""
+        used = [0] * (3 * self.size)
+        for i, v in enumerate(cells):
+            if v != 0:
+                bit = 1 << (v - 1)
+                for u in _units(i, self.size, self.root):
+                    if used[u] & bit:
+                        return
+                    used[u] |= bit
+        selected = []
+        try:
+            for i, v in enumerate(cells):
+                if v != 0:
+                    self.matrix.select(self.rows[i, v])
+                    selected.append(self.rows[i, v])
+            for placements in self.matrix.solutions():
+                out = cells[:]
+                for i, d in placements:
+                    out[i] = d
+                yield out
+        finally:
+            for row in reversed(selected):
+                self.matrix.deselect(row)
+
+    def count(self, cells, limit=None) -> int:
+        """Count the solutions of a serialized board, stopping at limit if given."""
+        n = 0
+        found = self.solutions(cells)
+        for _ in found:
+            n += 1
+            if limit is not None and n >= limit:
+                break
+        # restore the matrix now rather than whenever found is collected
+        found.close()
+        return n
+
+
+def sudoku_matrix(cells, size):
+    """Build the exact cover matrix of a serialized board.
+    Columns are the cell, row/digit, column/digit and quadrant/digit
+    constraints not already satisfied by the givens, and rows are the
+    (index, digit) placements that don't clash with the givens.
+    Returns None if the givens clash with each other."""
+    root = int(size**(1 / 2))
+    square = size * size
+    used = [0] * (3 * size)
+    for i, v in enumerate(cells):
+        if v != 0:
+            y, x = divmod(i, size)
+            bit = 1 << (v - 1)
+            for u in (y, size + x, 2 * size + root * (y // root) + x // root):
+                if used[u] & bit:
+                    return None
+                used[u] |= bit
+    # number the constraints that still need covering
+    column_ids = {}
+    for i, v in enumerate(cells):
+        if v == 0:
+            column_ids[i] = len(column_ids)
+    for u in range(3 * size):
+        for d in range(size):
+            if not used[u] & (1 << d):
+                column_ids[square + u * size + d] = len(column_ids)
+    matrix = DancingLinks(len(column_ids))
+    for i, v in enumerate(cells):
+        if v != 0:
+            continue
+        y, x = divmod(i, size)
+        units = (y, size + x, 2 * size + root * (y // root) + x // root)
+        taken = used[units[0]] | used[units[1]] | used[units[2]]
+        for d in range(size):
+            if not taken & (1 << d):
+                matrix.add_row([column_ids[i]] + [column_ids[square + u * size + d]
+                                                  for u in units], (i, d + 1))
+    return matrix
+
+
+def solutions(cells, size=9, stats=None):
+    """Generate every solution of a serialized board as a serialized board.
+    If stats is a dict, its "nodes" is kept up to date with the number of
+    rows the search has tried."""
+    matrix = sudoku_matrix(cells, size)
+    if matrix is None:
+        return
+    try:
+        for placements in matrix.solutions():
+            out = cells[:]
+            for i, d in placements:
+                out[i] = d
+            if stats is not None:
+                stats["nodes"] = matrix.nodes
+            yield out
+    finally:
+        if stats is not None:
+            stats["nodes"] = matrix.nodes
+
+
+def count(cells, size=9, limit=None) -> int:
+    """Count the solutions of a serialized board, stopping at limit if given."""
+    n = 0
+    for _ in solutions(cells, size):
+        n += 1
+        if limit is not None and n >= limit:
+            break
+    return n
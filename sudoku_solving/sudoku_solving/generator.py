@@ -0,0 +1,171 @@
+"""Generation of puzzles with unique solutions.
+Works on serialized boards, see the sudoku_solving package for wrappers
+returning SudokuBoard objects."""
+import random
+from . import dlx
+
+# past this size the exact cover search for a random full grid can run for
+# a very long time, so bigger grids are scrambled copies of a fixed pattern
+MAX_SEARCH_SIZE = 25
+
+# how many full grids generate() tries for a puzzle of a given difficulty
+# before giving up
+DIFFICULTY_ATTEMPTS = 50
+
+
+class PuzzleGenerator():
+
+    """Make puzzles of a given size by removing clues from random full grids
+    for as long as the solution stays unique.
+
+    The generator keeps a single SudokuExactCover for all of its uniqueness
+    checks (and for filling in the grids), so generating many puzzles only
+    pays for building the exact cover matrix once. The matrix is only built
+    when it is first needed, as big boards without uniqueness checks do
+    without it."""
+
+    def __init__(self, size=9, seed=None):
+        self.size = size
+        self.root = int(size**(1 / 2))
+        self.square = size * size
+        self.random = random.Random(seed)
+        self.cover = None
+
+    def _cover(self) -> dlx.SudokuExactCover:
+        if self.cover is None:
+            self.cover = dlx.SudokuExactCover(self.size)
+        return self.cover
+
+    def full_grid(self) -> list:
+        """Return a random completely filled serialized board."""
+        first = list(range(1, self.size + 1))
+        self.random.shuffle(first)
+        if self.size > MAX_SEARCH_SIZE:
+            # the pattern with the digits relabelled at random
+            grid = [first[(self.root * (y % self.root) + y // self.root + x) % self.size]
+                    for y in range(self.size) for x in range(self.size)]
+        else:
+            # a random first row pins down a random solution
+            grid = next(self._cover().solutions(first + [0] * (self.square - self.size)))
+        # shuffling rows and columns within their bands and stacks, and the
+        # bands and stacks themselves, scrambles the rest
+        rows = self._shuffled_lines()
+        cols = self._shuffled_lines()
+        return [grid[rows[y] * self.size + cols[x]]
+                for y in range(self.size) for x in range(self.size)]
+
+    def _shuffled_lines(self) -> list:
+        """Return a random permutation of line numbers that keeps lines in
+        the same band together."""
+        bands = list(range(self.root))
+        self.random.shuffle(bands)
+        out = []
+        for b in bands:
+            lines = list(range(b * self.root, (b + 1) * self.root))
+            self.random.shuffle(lines)
+            out.extend(lines)
+        return out
+
+    def is_unique(self, cells) -> bool:
+        """Return whether a serialized board has exactly one solution."""
+        return self._cover().count(cells, limit=2) == 1
+
+    def _removable(self, cells, removed) -> bool:
+        """Return whether the clues in removed, a list of (index, digit) pairs
+        already cleared from the uniquely solvable cells, can stay removed.
+        Rather than counting solutions from scratch this looks directly for
+        a second solution: one differing from the first in some removed cell,
+        with the removed cells before it keeping their digits."""
+        try:
+            for k, v in removed:
+                for d in range(1, self.size + 1):
+                    if d != v:
+                        cells[k] = d
+                        if self._cover().count(cells, limit=1):
+                            return False
+                cells[k] = v
+            return True
+        finally:
+            for k, _ in removed:
+                cells[k] = 0
+
+    def generate(self, clues=None, symmetric=False, unique=True, difficulty=None, rate=None,
+                 attempts=DIFFICULTY_ATTEMPTS) -> list:
+        """Return a serialized puzzle with a unique solution.
+        Clues are removed in random order until only clues remain, or until
+        no more can be removed without losing uniqueness. If symmetric is set,
+        clues are removed in pairs that are symmetric under a half turn.
+        If unique is False uniqueness isn't checked, which is far faster on
+        big boards, and the puzzle may have more than one solution.
+
+        With a difficulty, rate(cells, size) must return a number that grows
+        with how hard a serialized board is, such as the index of its level
+        of difficulty. Clues then also stay if removing them would make the
+        puzzle rate above difficulty, and the puzzle is only returned if it
+        ends up rated difficulty exactly. Otherwise a fresh grid is tried,
+        up to attempts of them before raising ValueError."""
+        if clues is None and not unique:
+            raise ValueError("Puzzles that needn't be unique need a number of clues.")
+        if difficulty is None:
+            return self._generate(clues or 0, symmetric, unique)
+        for _ in range(attempts):
+            cells = self._generate(clues or 0, symmetric, unique, difficulty, rate)
+            if rate(cells, self.size) == difficulty:
+                return cells
+        raise ValueError("No puzzle of difficulty {} found in {} attempts.".format(
+            difficulty, attempts))
+
+    def _generate(self, clues, symmetric, unique, difficulty=None, rate=None) -> list:
+        """Remove clues from a fresh full grid, see generate()."""
+        cells = self.full_grid()
+        order = list(range(self.square))
+        self.random.shuffle(order)
+        remaining = self.square
+        for i in order:
+            if remaining <= clues:
+                break
+            j = self.square - 1 - i
+            group = {i, j} if symmetric else {i}
+            if any(cells[k] == 0 for k in group):
+                continue
+            removed = [(k, cells[k]) for k in group]
+            for k in group:
+                cells[k] = 0
+            if ((not unique or self._removable(cells, removed)) and
+                    (difficulty is None or rate(cells, self.size) <= difficulty)):
+                remaining -= len(group)
+            else:
+                for k, v in removed:
+                    cells[k] = v
+        return cells
+
+
+# one generator per size for the life of the process, so that the exact cover
+# matrix is built once and reused from call to call
+_generators = {}
+
+
+def _generator(size) -> PuzzleGenerator:
+    if size not in _generators:
+        _generators[size] = PuzzleGenerator(size)
+    return _generators[size]
+
+
+def generate(size=9, clues=None, symmetric=False, seed=None, unique=True, difficulty=None,
+             rate=None) -> list:
+    """Return a serialized puzzle, see PuzzleGenerator.generate()."""
+    gen = _generator(size)
+    if seed is not None:
+        gen.random.seed(seed)
+    return gen.generate(clues, symmetric, unique, difficulty, rate)
+
+
+def generate_job(job) -> list:
+    """Generate one puzzle in a worker process.
+    job is a (size, clues, symmetric, seed, unique, difficulty, rate) tuple."""
+    size, clues, symmetric, seed, unique, difficulty, rate = job
+    if seed is None:
+        # a forked worker starts with a copy of its parent's random state,
+        # make sure it doesn't produce the same puzzles as its siblings
+        _generator(size).random.seed()
+    return generate(size, clues, symmetric, seed, unique, difficulty, rate)
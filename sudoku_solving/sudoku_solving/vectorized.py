@@ -0,0 +1,115 @@
+"""Constraint propagation over many boards at once with NumPy.
+A batch of N boards is held as an (N, size, size, words) array of
+candidate bitmasks (bit d-1 set while digit d is possible, split into
+64 bit words on boards of more than 64 digits) and naked and hidden
+singles are applied to every board of the batch in the same array
+operations. propagate_batch() takes and returns the boards as rows of
+serialized digits.
+
+NumPy is optional: install it to use this module, which is otherwise
+importable but raises ImportError when called."""
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# values of the status array returned by propagate_batch()
+OPEN = 0
+SOLVED = 1
+CONTRADICTION = -1
+
+
+def available() -> bool:
+    """Return whether NumPy is installed."""
+    return np is not None
+
+
+def _layout(size) -> tuple:
+    """Return (dtype, words): the candidates of a cell are held in words
+    integers of dtype, digits 1 to 64 in the first, 65 to 128 in the next
+    and so on, so boards of any size fit."""
+    if np is None:
+        raise ImportError("Vectorized propagation needs numpy.")
+    for bits, dtype in ((16, np.uint16), (32, np.uint32), (64, np.uint64)):
+        if size <= bits:
+            return dtype, 1
+    return np.uint64, -(-size // 64)
+
+
+def _box_spread(a, n, root):
+    """Broadcast an (n, root, root, ...) array of per-quadrant values back to
+    (n, size, size, ...) cells."""
+    size = root * root
+    rest = a.shape[3:]
+    spread = np.broadcast_to(a[:, :, None, :, None], (n, root, root, root, root) + rest)
+    return spread.reshape((n, size, size) + rest)
+
+
+def _box_view(a, n, root):
+    """View an (n, size, size, ...) array as (n, band, row, stack, column, ...)."""
+    return a.reshape((n, root, root, root, root) + a.shape[3:])
+
+
+def propagate_batch(cells, size=9):
+    """Apply naked and hidden singles to a batch of boards until none of
+    them changes any more.
+
+    cells is anything NumPy can turn into an (N, size * size) array of
+    serialized boards, such as a list of lists.
+    Returns (filled, status): filled is an (N, size * size) array of the
+    boards with every deduced digit filled in, and status holds SOLVED,
+    CONTRADICTION (including clashing givens) or OPEN for each board."""
+    dtype, words = _layout(size)
+    root = int(size**(1 / 2))
+    grid = np.asarray(cells, dtype=np.int64).reshape(-1, size, size)
+    n = len(grid)
+    one = dtype(1)
+    # bits[d] is the mask of digit d + 1 and full the mask of every digit
+    bits = np.zeros((size, words), dtype=dtype)
+    for d in range(size):
+        bits[d, d // 64] = one << dtype(d % 64)
+    full = np.bitwise_or.reduce(bits, axis=0)
+    masks = np.where((grid > 0)[..., None], bits[np.maximum(grid - 1, 0)], full)
+    dead = np.zeros(n, dtype=bool)
+    while True:
+        empty = (masks == 0).all(axis=3)
+        single = ~empty & ((masks & (masks - one)) == 0).all(axis=3) & (
+            (masks != 0).sum(axis=3) == 1)
+        dead |= empty.any(axis=(1, 2))
+        fixed = np.where(single[..., None], masks, dtype(0))
+        # naked singles: remove the digits fixed in each unit from the others
+        rows = np.bitwise_or.reduce(fixed, axis=2)
+        cols = np.bitwise_or.reduce(fixed, axis=1)
+        boxes = np.bitwise_or.reduce(np.bitwise_or.reduce(_box_view(fixed, n, root), axis=4), axis=2)
+        used = rows[:, :, None] | cols[:, None, :] | _box_spread(boxes, n, root)
+        new = np.where(single[..., None], masks, masks & ~used)
+        # hidden singles: a digit with one place left in a unit goes there
+        for d in range(size):
+            word = d // 64
+            bit = bits[d, word]
+            fixed_d = (fixed[..., word] & bit) != 0
+            has_d = (new[..., word] & bit) != 0
+            counts = (fixed_d.sum(axis=2), fixed_d.sum(axis=1),
+                      _box_view(fixed_d, n, root).sum(axis=(2, 4)))
+            for c in counts:
+                # the digit fixed twice in a unit
+                dead |= (c > 1).reshape(n, -1).any(axis=1)
+            row_count = has_d.sum(axis=2)
+            col_count = has_d.sum(axis=1)
+            box_count = _box_view(has_d, n, root).sum(axis=(2, 4))
+            for c in (row_count, col_count, box_count):
+                # the digit has nowhere to go in a unit
+                dead |= (c == 0).reshape(n, -1).any(axis=1)
+            only = has_d & ((row_count == 1)[:, :, None] | (col_count == 1)[:, None, :] |
+                            _box_spread(box_count == 1, n, root))
+            new = np.where(only[..., None], bits[d], new)
+        if np.array_equal(new, masks):
+            break
+        masks = new
+    filled = np.zeros((n, size, size), dtype=np.int64)
+    for d in range(size):
+        filled[(masks == bits[d]).all(axis=3)] = d + 1
+    status = np.full(n, OPEN, dtype=np.int8)
+    status[(filled > 0).all(axis=(1, 2))] = SOLVED
+    status[dead] = CONTRADICTION
+    return filled.reshape(n, size * size), status